@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Drawing, Layer
+from .models import PUBLISH_GEOMETRY, Drawing, Layer, publish_geometry, purge_layers
 
 
 class LayerInline(admin.TabularInline):
@@ -8,6 +8,9 @@ class LayerInline(admin.TabularInline):
     fields = ("name", "color_field", "linetype")
     extra = 0
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).active().defer("geom")
+
 
 @admin.register(Drawing)
 class DrawingAdmin(admin.ModelAdmin):
@@ -16,3 +19,19 @@ class DrawingAdmin(admin.ModelAdmin):
     inlines = [
         LayerInline,
     ]
+
+    def save_model(self, request, obj, form, change):
+        if "image" in form.changed_data:
+            obj.make_thumbnail()
+        super().save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # exported geometry carries layer style
+        if PUBLISH_GEOMETRY and change:
+            publish_geometry(form.instance)
+
+    def delete_queryset(self, request, queryset):
+        # layers and entities are not loaded by the ORM collector
+        purge_layers(list(queryset.values_list("id", flat=True)))
+        super().delete_queryset(request, queryset)
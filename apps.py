@@ -1,5 +1,5 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.utils.translation import gettext as _
 
 
@@ -16,6 +16,28 @@ def create_djeocad_group(sender, **kwargs):
         grp.permissions.set(permissions)
 
 
+def reset_marker_clusters(sender, **kwargs):
+    from .views import invalidate_clusters
+
+    invalidate_clusters()
+
+
+def drop_drawing_index(sender, instance, **kwargs):
+    from .spatial import drawing_indexes
+
+    drawing_indexes.invalidate(instance.id)
+
+
+def delete_export(sender, instance, **kwargs):
+    if instance.export:
+        instance.export.delete(save=False)
+
+
+def delete_preview(sender, instance, **kwargs):
+    if instance.preview:
+        instance.preview.delete(save=False)
+
+
 class DjeocadengineConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "djeocadengine"
@@ -23,3 +45,10 @@ class DjeocadengineConfig(AppConfig):
     def ready(self):
 
         post_migrate.connect(create_djeocad_group, sender=self)
+        Drawing = self.get_model("Drawing")
+        post_save.connect(reset_marker_clusters, sender=Drawing)
+        post_delete.connect(reset_marker_clusters, sender=Drawing)
+        post_delete.connect(delete_export, sender=Drawing)
+        post_delete.connect(delete_preview, sender=Drawing)
+        post_delete.connect(drop_drawing_index, sender=Drawing)
+        post_delete.connect(delete_export, sender=self.get_model("Layer"))
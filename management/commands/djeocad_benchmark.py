@@ -0,0 +1,201 @@
+import csv
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from math import ceil, sqrt
+from pathlib import Path
+from time import perf_counter
+
+import django
+import ezdxf
+from django.contrib.auth.models import AnonymousUser
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from django_htmx.middleware import HtmxDetails
+from djeocadengine.models import Drawing, Entity, Layer
+from djeocadengine.views import DrawingDetailView
+
+# share of entities for each type in a synthetic drawing
+MIX = {
+    "polylines": 0.4,
+    "hatches": 0.15,
+    "splines": 0.15,
+    "inserts": 0.3,
+}
+# CAD / geo libraries that must not be loaded when Django starts
+HEAVY_MODULES = ["ezdxf", "numpy", "pyproj", "shapely"]
+
+
+def make_synthetic_dxf(
+    path, layers=10, polylines=0, hatches=0, splines=0, blocks=5, inserts=0
+):
+    """Writes an ASCII DXF with the requested number of entities.
+    Polylines are closed rooms labelled with a TEXT, blocks have an
+    ASSET attribute that is filled in by each INSERT"""
+    doc = ezdxf.new("R2010")
+    msp = doc.modelspace()
+    layer_names = [f"layer_{i}" for i in range(layers)]
+    for i, name in enumerate(layer_names):
+        doc.layers.add(name, color=i % 255 + 1)
+    block_names = [f"block_{i}" for i in range(blocks)]
+    for name in block_names:
+        block = doc.blocks.new(name=name)
+        block.add_circle((0, 0), 0.5)
+        block.add_lwpolyline(
+            [(-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)], close=True
+        )
+        block.add_attdef("ASSET", (0, 0))
+    # entities are placed on a grid of 5 x 5 meters cells
+    total = polylines + hatches + splines + (inserts if block_names else 0)
+    side = max(ceil(sqrt(total)), 1)
+    cells = ((i % side * 5.0, i // side * 5.0) for i in range(total))
+    for i in range(polylines):
+        x, y = next(cells)
+        attribs = {"layer": layer_names[i % layers]}
+        msp.add_lwpolyline(
+            [(x, y), (x + 4, y), (x + 4, y + 4), (x, y + 4)],
+            close=True,
+            dxfattribs=attribs,
+        )
+        msp.add_text(f"Room {i}", dxfattribs=attribs).set_placement((x + 2, y + 2))
+    for i in range(hatches):
+        x, y = next(cells)
+        hatch = msp.add_hatch(dxfattribs={"layer": layer_names[i % layers]})
+        hatch.paths.add_polyline_path(
+            [(x, y), (x + 4, y), (x + 4, y + 4), (x, y + 4)], is_closed=True
+        )
+    for i in range(splines):
+        x, y = next(cells)
+        msp.add_spline(
+            fit_points=[(x, y), (x + 1, y + 3), (x + 3, y + 1), (x + 4, y + 4)],
+            dxfattribs={"layer": layer_names[i % layers]},
+        )
+    for i in range(inserts if block_names else 0):
+        x, y = next(cells)
+        ref = msp.add_blockref(
+            block_names[i % blocks],
+            (x + 2, y + 2),
+            dxfattribs={"layer": layer_names[i % layers]},
+        )
+        ref.add_auto_attribs({"ASSET": str(i)})
+    doc.saveas(path, encoding="utf-8", fmt="asc")
+    return path
+
+
+def measure_startup():
+    """Sets up Django and imports app urls and admin in a new interpreter
+    with -X importtime, returns import time (seconds) and heavy modules
+    that were loaded. DJANGO_SETTINGS_MODULE is inherited"""
+    code = (
+        "import django; django.setup(); "
+        "import djeocadengine.urls, djeocadengine.admin"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    loaded = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        cumulative, name = line.split("|")[1:]
+        if not cumulative.strip().isdigit():
+            continue
+        # nested imports are indented, only top level ones add up
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+        # heavy modules are usually imported by other modules
+        name = name.strip()
+        if name in HEAVY_MODULES:
+            loaded.append(name)
+    return {"imports": round(total / 10**6, 4), "heavy_modules": sorted(loaded)}
+
+
+def timed(func, *args, **kwargs):
+    start = perf_counter()
+    func(*args, **kwargs)
+    return round(perf_counter() - start, 4)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks extraction, CSV export and detail rendering of drawings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[1000, 10000, 100000],
+            help="Number of entities of each synthetic drawing",
+        )
+        parser.add_argument("--layers", type=int, default=10)
+        parser.add_argument("--blocks", type=int, default=5)
+        parser.add_argument(
+            "--output",
+            help="Write JSON results to this file instead of standard output",
+        )
+
+    def handle(self, *args, **options):
+        results = {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "ezdxf": ezdxf.__version__,
+            "startup": measure_startup(),
+            "runs": [],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            for size in options["sizes"]:
+                counts = {k: int(size * v) for k, v in MIX.items()}
+                path = make_synthetic_dxf(
+                    Path(tmp).joinpath(f"synthetic_{size}.dxf"),
+                    layers=options["layers"],
+                    blocks=options["blocks"],
+                    **counts,
+                )
+                results["runs"].append(self.run_benchmark(size, path))
+                self.stderr.write(f"Benchmarked {size} entities")
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            Path(options["output"]).write_text(output)
+        else:
+            self.stdout.write(output)
+
+    def run_benchmark(self, size, path):
+        run = {"entities": size}
+        # everything is rolled back, stored files are removed at the end
+        with transaction.atomic():
+            with open(path, "rb") as f:
+                drawing = Drawing(
+                    title=f"Benchmark {size}",
+                    dxf=File(f, name=path.name),
+                    geom={"type": "Point", "coordinates": [12.0, 42.0]},
+                )
+                run["save"] = timed(drawing.save)
+            run["extraction_stats"] = drawing.extraction_stats
+            run["layers"] = Layer.objects.filter(drawing=drawing).count()
+            run["rows"] = Entity.objects.filter(drawing=drawing).count()
+            run["csv"] = timed(drawing.write_csv, csv.writer(io.StringIO()))
+            request = RequestFactory().get(drawing.get_absolute_url())
+            request.user = AnonymousUser()
+            request.htmx = HtmxDetails(request)
+            view = DrawingDetailView.as_view()
+            run["detail"] = timed(lambda: view(request, pk=drawing.id).render())
+            # extraction also stores preview and geometry exports
+            exports = Layer.objects.filter(drawing=drawing).exclude(export="")
+            for name in exports.values_list("export", flat=True):
+                Layer._meta.get_field("export").storage.delete(name)
+            for field in [drawing.dxf, drawing.preview, drawing.export]:
+                if field:
+                    field.delete(save=False)
+            transaction.set_rollback(True)
+        return run
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from djeocadengine.models import Drawing, publish_geometry
+
+
+class Command(BaseCommand):
+    help = "Publishes geometry of extracted drawings as static GeoJSON files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids",
+            nargs="*",
+            type=int,
+            help="Drawings to publish, all extracted drawings if omitted",
+        )
+
+    def handle(self, *args, **options):
+        drawings = Drawing.objects.filter(related_layers__isnull=False).distinct()
+        if options["ids"]:
+            drawings = drawings.filter(id__in=options["ids"])
+        for drawing in drawings:
+            publish_geometry(drawing)
+            self.stdout.write(f"Published {drawing}")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from djeocadengine.models import Drawing
+
+
+class Command(BaseCommand):
+    help = "Stores popup thumbnails of drawings with an image and no thumbnail"
+
+    def handle(self, *args, **options):
+        drawings = Drawing.objects.filter(image__isnull=False, thumbnail_url="")
+        for drawing in drawings:
+            drawing.make_thumbnail()
+            Drawing.objects.filter(id=drawing.id).update(
+                thumbnail_url=drawing.thumbnail_url
+            )
+            self.stdout.write(f"Thumbnail of {drawing}")
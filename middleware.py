@@ -0,0 +1,187 @@
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from statistics import mean
+from threading import Lock
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+METRICS_WINDOW = getattr(settings, "CAD_METRICS_WINDOW", 500)
+
+
+class RequestMetrics:
+    """Keeps the last samples of each djeocadengine view in process memory"""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = Lock()
+
+    def add(self, name, sample):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(sample)
+
+    def clear(self):
+        with self.lock:
+            self.samples = {}
+
+    def aggregates(self):
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+        aggregates = {}
+        for name, values in samples.items():
+            aggregates[name] = {"count": len(values)}
+            for key in values[0]:
+                column = [v[key] for v in values]
+                aggregates[name][key] = {
+                    "mean": round(mean(column), 2),
+                    "max": round(max(column), 2),
+                }
+        return aggregates
+
+
+request_metrics = RequestMetrics()
+
+
+class QueryTimer:
+    """Database execute wrapper counting queries and their time"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += perf_counter() - start
+
+
+@contextmanager
+def timed_queries(queries):
+    """Counts queries of all database connections with queries timer"""
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(queries))
+        yield
+
+
+@asynccontextmanager
+async def atimed_queries(queries):
+    """timed_queries for async code: connections are local to threads,
+    and queries of the async ORM (and of sync views) run in the thread
+    of thread sensitive calls, so the wrappers are installed there"""
+    timer = timed_queries(queries)
+    await sync_to_async(timer.__enter__)()
+    try:
+        yield
+    finally:
+        await sync_to_async(timer.__exit__)(None, None, None)
+
+
+class ServerTimingMiddleware:
+    """Opt-in middleware that measures djeocadengine views: SQL queries,
+    template rendering and response size are exposed in the Server-Timing
+    header and added to request_metrics. Headers of streamed responses are
+    sent before the content, so their header only covers the time until
+    streaming starts, while request_metrics gets the whole stream"""
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryTimer()
+        start = perf_counter()
+        with timed_queries(queries):
+            response = self.get_response(request)
+        return self.measure(request, response, queries, start)
+
+    async def __acall__(self, request):
+        queries = QueryTimer()
+        start = perf_counter()
+        async with atimed_queries(queries):
+            response = await self.get_response(request)
+        return self.measure(request, response, queries, start)
+
+    def measure(self, request, response, queries, start):
+        total = perf_counter() - start
+        match = request.resolver_match
+        if not match or match.namespace != "djeocadengine":
+            return response
+        render = getattr(request, "_djeocad_render", 0)
+        size = 0 if response.streaming else len(response.content)
+        response["Server-Timing"] = ", ".join(
+            [
+                'sql;dur=%.1f;desc="%s queries"' % (queries.time * 1000, queries.count),
+                "render;dur=%.1f" % (render * 1000),
+                "total;dur=%.1f" % (total * 1000),
+                'size;desc="%s bytes"' % size,
+            ]
+        )
+        name = match.url_name
+        if request.headers.get("HX-Request"):
+            name += "#htmx"
+        sample = {
+            "queries": queries.count,
+            "sql_ms": queries.time * 1000,
+            "render_ms": render * 1000,
+            "total_ms": total * 1000,
+            "bytes": size,
+        }
+        if not response.streaming:
+            request_metrics.add(name, sample)
+        elif response.is_async:
+            response.streaming_content = self.astream(
+                response.streaming_content, name, sample, queries, start
+            )
+        else:
+            response.streaming_content = self.stream(
+                response.streaming_content, name, sample, queries, start
+            )
+        return response
+
+    def stream(self, content, name, sample, queries, start):
+        try:
+            with timed_queries(queries):
+                for chunk in content:
+                    sample["bytes"] += len(chunk)
+                    yield chunk
+        finally:
+            self.add_stream(name, sample, queries, start)
+
+    async def astream(self, content, name, sample, queries, start):
+        try:
+            async with atimed_queries(queries):
+                async for chunk in content:
+                    sample["bytes"] += len(chunk)
+                    yield chunk
+        finally:
+            self.add_stream(name, sample, queries, start)
+
+    def add_stream(self, name, sample, queries, start):
+        sample["queries"] = queries.count
+        sample["sql_ms"] = queries.time * 1000
+        sample["total_ms"] = (perf_counter() - start) * 1000
+        request_metrics.add(name, sample)
+
+    def process_template_response(self, request, response):
+        start = perf_counter()
+
+        def rendered(response):
+            request._djeocad_render = perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0010_remove_drawing_lat_remove_drawing_long"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="extraction_stats",
+            field=models.JSONField(
+                editable=False, null=True, verbose_name="Extraction statistics"
+            ),
+        ),
+    ]
@@ -0,0 +1,161 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:13
+
+from django.db import migrations, models
+
+
+def get_bounds(geometries, bounds=None):
+    for geometry in geometries:
+        if geometry["type"] == "GeometryCollection":
+            bounds = get_bounds(geometry["geometries"], bounds)
+            continue
+        stack = [geometry["coordinates"]]
+        while stack:
+            coords = stack.pop()
+            if not coords:
+                continue
+            if not isinstance(coords[0], (int, float)):
+                stack.extend(coords)
+                continue
+            bounds = merge_bounds(bounds, (coords[0], coords[1]) * 2)
+    return bounds
+
+
+def merge_bounds(bounds, other):
+    if bounds is None:
+        return other
+    if other is None:
+        return bounds
+    return (
+        min(bounds[0], other[0]),
+        min(bounds[1], other[1]),
+        max(bounds[2], other[2]),
+        max(bounds[3], other[3]),
+    )
+
+
+def set_bounds(obj, bounds):
+    obj.minx, obj.miny, obj.maxx, obj.maxy = bounds
+
+
+def backfill_bounds(apps, schema_editor):
+    Drawing = apps.get_model("djeocadengine", "Drawing")
+    Layer = apps.get_model("djeocadengine", "Layer")
+    Entity = apps.get_model("djeocadengine", "Entity")
+    fields = ["minx", "miny", "maxx", "maxy"]
+    for drawing in Drawing.objects.all():
+        drawing_bounds = None
+        for layer in Layer.objects.filter(drawing_id=drawing.id):
+            layer_bounds = None
+            if layer.geom:
+                layer_bounds = get_bounds(layer.geom["geometries"])
+            entities = []
+            for entity in Entity.objects.filter(layer_id=layer.id):
+                geometries = list(entity.geom["geometries"]) if entity.geom else []
+                if entity.insertion:
+                    geometries.append(entity.insertion)
+                entity_bounds = get_bounds(geometries)
+                if entity_bounds is None:
+                    continue
+                set_bounds(entity, entity_bounds)
+                entities.append(entity)
+                layer_bounds = merge_bounds(layer_bounds, entity_bounds)
+            Entity.objects.bulk_update(entities, fields)
+            if layer_bounds is None:
+                continue
+            set_bounds(layer, layer_bounds)
+            layer.save(update_fields=fields)
+            # blocks are placed on WCS origin
+            if not layer.is_block:
+                drawing_bounds = merge_bounds(drawing_bounds, layer_bounds)
+        if drawing_bounds is not None:
+            set_bounds(drawing, drawing_bounds)
+            drawing.save(update_fields=fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0011_drawing_extraction_stats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="maxx",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="drawing",
+            name="maxy",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="drawing",
+            name="minx",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="drawing",
+            name="miny",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="maxx",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="maxy",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="minx",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="miny",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="maxx",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="maxy",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="minx",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="miny",
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="drawing",
+            index=models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="drawing_bounds_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="entity",
+            index=models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="entity_bounds_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="layer",
+            index=models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="layer_bounds_idx"
+            ),
+        ),
+        migrations.RunPython(backfill_bounds, migrations.RunPython.noop),
+    ]
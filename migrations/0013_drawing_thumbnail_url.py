@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "djeocadengine",
+            "0012_drawing_maxx_drawing_maxy_drawing_minx_drawing_miny_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="thumbnail_url",
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+    ]
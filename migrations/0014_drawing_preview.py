@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0013_drawing_thumbnail_url"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="preview",
+            field=models.FileField(
+                blank=True,
+                editable=False,
+                max_length=200,
+                null=True,
+                upload_to="uploads/djeocad/preview/",
+                verbose_name="Preview",
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0014_drawing_preview"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="export",
+            field=models.FileField(
+                blank=True,
+                editable=False,
+                max_length=200,
+                null=True,
+                upload_to="uploads/djeocad/geometry/",
+                verbose_name="GeoJSON export",
+            ),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="export",
+            field=models.FileField(
+                blank=True,
+                editable=False,
+                max_length=200,
+                null=True,
+                upload_to="uploads/djeocad/geometry/",
+                verbose_name="GeoJSON export",
+            ),
+        ),
+    ]
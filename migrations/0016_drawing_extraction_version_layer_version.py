@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0015_drawing_export_layer_export"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="extraction_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
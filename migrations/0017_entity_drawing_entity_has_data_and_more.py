@@ -0,0 +1,71 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_drawing(apps, schema_editor):
+    Layer = apps.get_model("djeocadengine", "Layer")
+    Entity = apps.get_model("djeocadengine", "Entity")
+    Entity.objects.update(
+        drawing_id=Subquery(
+            Layer.objects.filter(id=OuterRef("layer_id")).values("drawing_id")[:1]
+        )
+    )
+    Entity.objects.filter(data__isnull=False).update(has_data=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0016_drawing_extraction_version_layer_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entity",
+            name="drawing",
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="related_entities",
+                to="djeocadengine.drawing",
+            ),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="has_data",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(backfill_drawing, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="entity",
+            name="drawing",
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="related_entities",
+                to="djeocadengine.drawing",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="entity",
+            index=models.Index(
+                fields=["drawing", "layer"], name="entity_drawing_layer_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="entity",
+            index=models.Index(
+                fields=["drawing", "has_data"], name="entity_drawing_data_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="layer",
+            index=models.Index(
+                fields=["drawing", "is_block"], name="layer_drawing_block_idx"
+            ),
+        ),
+    ]
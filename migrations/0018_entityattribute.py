@@ -0,0 +1,79 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_attributes(apps, schema_editor):
+    Entity = apps.get_model("djeocadengine", "Entity")
+    EntityAttribute = apps.get_model("djeocadengine", "EntityAttribute")
+    attributes = []
+    for entity in Entity.objects.filter(has_data=True).only("id", "drawing", "data"):
+        data = entity.data or {}
+        pairs = [(k, data[k]) for k in ("Name", "Block") if data.get(k)]
+        pairs += list(data.get("attributes", {}).items())
+        for key, value in pairs:
+            if not str(value).strip():
+                continue
+            attributes.append(
+                EntityAttribute(
+                    drawing_id=entity.drawing_id,
+                    entity_id=entity.id,
+                    key=str(key)[:50],
+                    value=str(value)[:200],
+                    term=str(value).strip().casefold()[:200],
+                )
+            )
+    EntityAttribute.objects.bulk_create(attributes, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0017_entity_drawing_entity_has_data_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EntityAttribute",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=50, verbose_name="Key")),
+                ("value", models.CharField(max_length=200, verbose_name="Value")),
+                ("term", models.CharField(editable=False, max_length=200)),
+                (
+                    "drawing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="related_attributes",
+                        to="djeocadengine.drawing",
+                    ),
+                ),
+                (
+                    "entity",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="related_attributes",
+                        to="djeocadengine.entity",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Entity attribute",
+                "verbose_name_plural": "Entity attributes",
+                "indexes": [
+                    models.Index(fields=["term"], name="attribute_term_idx"),
+                    models.Index(fields=["key", "term"], name="attribute_key_term_idx"),
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_attributes, migrations.RunPython.noop),
+    ]
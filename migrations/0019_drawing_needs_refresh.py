@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0018_entityattribute"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="needs_refresh",
+            field=models.BooleanField(
+                default=False, editable=False, verbose_name="Refresh DXF geodata"
+            ),
+        ),
+    ]
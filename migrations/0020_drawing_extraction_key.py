@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocadengine", "0019_drawing_needs_refresh"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="extraction_key",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -1,29 +1,96 @@
+import hashlib
 import json
-from math import atan2, cos, degrees, radians, sin
+import logging
+import os
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from math import atan2, cos, degrees, radians, sin, tau
+from time import perf_counter
 
-import ezdxf
 import nh3
 from colorfield.fields import ColorField
 from django.conf import settings
+from django.core.files.base import ContentFile
 from django.core.validators import FileExtensionValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from djgeojson.fields import GeometryCollectionField, PointField
-from easy_thumbnails.files import get_thumbnailer
-from ezdxf import colors
-from ezdxf.addons import geo
-from ezdxf.lldxf.const import InvalidGeoDataException
-from ezdxf.math import Vec3
 from filer.fields.image import FilerImageField
-from pyproj import Transformer
-from pyproj.aoi import AreaOfInterest
-from pyproj.database import query_utm_crs_info
-from shapely.geometry import Point, shape
-from shapely.geometry.polygon import Polygon
 
+from .signals import extraction_finished
+from .transport import dumps_geojson
 
-class Drawing(models.Model):
+logger = logging.getLogger(__name__)
+
+# ezdxf, pyproj and shapely are imported where extraction and
+# georeferencing need them, processes serving maps never load them
+
+# SVG previews are simplified and capped in size (bytes)
+PREVIEW_FLATTENING = getattr(settings, "CAD_PREVIEW_FLATTENING", 0.1)
+PREVIEW_MAX_SIZE = getattr(settings, "CAD_PREVIEW_MAX_SIZE", 200_000)
+# previews of larger drawings show only the biggest entities, without
+# hatches, texts and blocks
+PREVIEW_MAX_ENTITIES = getattr(settings, "CAD_PREVIEW_MAX_ENTITIES", 1000)
+PREVIEW_SKIP_TYPES = ["HATCH", "TEXT", "MTEXT", "INSERT", "POINT"]
+# curves are flattened to a max chord deviation (drawing units), within
+# min / max number of segments for each entity type
+FLATTENING_DISTANCE = getattr(settings, "CAD_FLATTENING_DISTANCE", 0.1)
+FLATTENING_SEGMENTS = getattr(
+    settings,
+    "CAD_FLATTENING_SEGMENTS",
+    {"ARC": (2, 32), "CIRCLE": (8, 64), "ELLIPSE": (8, 64), "SPLINE": (4, 128)},
+)
+# invalid polygons are dropped unless repaired with make_valid
+REPAIR_POLYGONS = getattr(settings, "CAD_REPAIR_POLYGONS", False)
+# larger polygons are always checked by GEOS
+CONVEX_CHECK_SIZE = 32
+# geometry is published as static files on extraction
+PUBLISH_GEOMETRY = getattr(settings, "CAD_PUBLISH_GEOMETRY", True)
+
+
+class BoundsQuerySet(models.QuerySet):
+    def overlapping(self, minx, miny, maxx, maxy):
+        """Rows whose bounding box overlaps given one"""
+        return self.filter(
+            minx__lte=maxx, maxx__gte=minx, miny__lte=maxy, maxy__gte=miny
+        )
+
+
+class LayerQuerySet(BoundsQuerySet):
+    def active(self):
+        """Layers of current extraction of their drawing"""
+        return self.filter(version=models.F("drawing__extraction_version"))
+
+
+class BoundsModel(models.Model):
+    """Bounding box of stored geometries, in longitude / latitude"""
+
+    minx = models.FloatField(null=True, editable=False)
+    miny = models.FloatField(null=True, editable=False)
+    maxx = models.FloatField(null=True, editable=False)
+    maxy = models.FloatField(null=True, editable=False)
+
+    objects = BoundsQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    @property
+    def bounds(self):
+        if self.minx is None:
+            return None
+        return (self.minx, self.miny, self.maxx, self.maxy)
+
+    @property
+    def leaflet_bounds(self):
+        if self.minx is None:
+            return None
+        return [[self.miny, self.minx], [self.maxy, self.maxx]]
+
+
+class Drawing(BoundsModel):
 
     title = models.CharField(
         _("Name"),
@@ -54,6 +121,22 @@ class Drawing(models.Model):
             )
         ],
     )
+    preview = models.FileField(
+        _("Preview"),
+        max_length=200,
+        upload_to="uploads/djeocad/preview/",
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    export = models.FileField(
+        _("GeoJSON export"),
+        max_length=200,
+        upload_to="uploads/djeocad/geometry/",
+        null=True,
+        blank=True,
+        editable=False,
+    )
     geom = PointField(_("Location"), null=True)
     designx = models.FloatField(
         _("Design point X..."),
@@ -72,10 +155,42 @@ class Drawing(models.Model):
         null=True,
         editable=False,
     )
+    thumbnail_url = models.CharField(
+        max_length=200,
+        blank=True,
+        editable=False,
+    )
+    extraction_stats = models.JSONField(
+        _("Extraction statistics"),
+        null=True,
+        editable=False,
+    )
+    # layers of a new extraction are written with next version
+    extraction_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+    )
+    # geodata of DXF is rewritten on download, see propagate_georeferencing
+    needs_refresh = models.BooleanField(
+        _("Refresh DXF geodata"),
+        default=False,
+        editable=False,
+    )
+    # DXF and georeferencing of last completed extraction, see extraction_key
+    extraction_key = models.CharField(
+        max_length=64,
+        blank=True,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = _("Drawing")
         verbose_name_plural = _("Drawings")
+        indexes = [
+            models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="drawing_bounds_idx"
+            ),
+        ]
 
     __original_dxf = None
     __original_geom = None
@@ -117,6 +232,12 @@ class Drawing(models.Model):
     def get_absolute_url(self):
         return reverse("djeocadengine:drawing_detail", kwargs={"pk": self.id})
 
+    def get_overlapping(self):
+        """Other drawings whose bounding box overlaps this one"""
+        if not self.bounds:
+            return Drawing.objects.none()
+        return Drawing.objects.exclude(id=self.id).overlapping(*self.bounds)
+
     @property
     def popupContent(self):
         url = self.get_absolute_url()
@@ -128,17 +249,54 @@ class Drawing(models.Model):
                 "url": url,
             }
         )
-        image = self.image
-        if not image:
-            return {"content": title_str}
-        thumbnailer = get_thumbnailer(image)
-        thumb = thumbnailer.get_thumbnail({"size": (256, 192), "crop": True})
-        image_str = '<img src="%(image)s">' % {"image": thumb.url}
+        thumbnail_url = self.thumbnail_url
+        if not thumbnail_url:
+            if not self.preview:
+                return {"content": title_str}
+            thumbnail_url = self.preview.url
+        image_str = '<img src="%(image)s">' % {"image": thumbnail_url}
         return {"content": image_str + "<br>" + title_str}
 
+    def get_thumbnail_url(self):
+        from easy_thumbnails.files import get_thumbnailer
+
+        thumbnailer = get_thumbnailer(self.image)
+        thumb = thumbnailer.get_thumbnail({"size": (256, 192), "crop": True})
+        return thumb.url
+
+    def get_feature_collection(self):
+        """Entities of all layers, blocks excluded"""
+        entities = (
+            self.related_entities.filter(
+                layer__version=self.extraction_version,
+                layer__is_block=False,
+            )
+            .select_related("layer")
+            .defer("layer__geom")
+        )
+        return {
+            "type": "FeatureCollection",
+            "features": [e.get_feature() for e in entities],
+        }
+
+    def make_thumbnail(self):
+        """Generates popup thumbnail, call it when image is assigned"""
+        self.thumbnail_url = self.get_thumbnail_url() if self.image else ""
+
+    def delete(self, *args, **kwargs):
+        # layers and entities are not loaded by the ORM collector
+        with transaction.atomic():
+            purge_layers([self.id])
+            return super().delete(*args, **kwargs)
+
     def save(self, *args, **kwargs):
+        # extraction state is written by extraction with queryset updates,
+        # a stale instance (i.e. a form) must not overwrite it
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = edited_fields()
         # save and eventually upload DXF
         super().save(*args, **kwargs)
+        kwargs.setdefault("update_fields", edited_fields())
         # check if we have coordinate system
         if not self.epsg:
             # check if user has inserted parent
@@ -158,6 +316,9 @@ class Drawing(models.Model):
                 if isinstance(self.geom, str):
                     self.geom = json.loads(self.geom)
                 # let's find proper UTM
+                from pyproj.aoi import AreaOfInterest
+                from pyproj.database import query_utm_crs_info
+
                 utm_crs_list = query_utm_crs_info(
                     datum_name="WGS 84",
                     area_of_interest=AreaOfInterest(
@@ -174,7 +335,14 @@ class Drawing(models.Model):
                 return
             # no user input, search for geodata in dxf
             else:
-                doc = ezdxf.readfile(self.dxf.path)
+                import ezdxf
+                from ezdxf.lldxf.const import InvalidGeoDataException
+
+                stats = ExtractionStats()
+                with stats.phase("parse"):
+                    doc = ezdxf.readfile(self.dxf.path)
+                # preview is shown also for unreferenced drawings
+                make_preview(self, doc, stats)
                 msp = doc.modelspace()
                 geodata = msp.get_geodata()
                 if geodata:
@@ -185,7 +353,7 @@ class Drawing(models.Model):
                             return
                     except InvalidGeoDataException:
                         return
-                    utm2world = Transformer.from_crs(self.epsg, 4326, always_xy=True)
+                    utm2world = get_transformer(self.epsg, 4326)
                     world_point = utm2world.transform(
                         geodata.dxf.reference_point[0], geodata.dxf.reference_point[1]
                     )
@@ -200,54 +368,60 @@ class Drawing(models.Model):
                     )
                     super().save(*args, **kwargs)
                     # we have eveything we need, go ahead!
-                    extract_dxf(self, doc)
+                    extract_dxf(self, doc, stats=stats)
                 return
         # check if something changed
-        if (
-            self.__original_dxf != self.dxf
-            or self.__original_geom != self.geom
+        moved = (
+            self.__original_geom != self.geom
             or self.__original_designx != self.designx
             or self.__original_designy != self.designy
             or self.__original_rotation != self.rotation
-        ):
-            all_layers = self.related_layers.all()
-            if all_layers.exists():
-                all_layers.delete()
+        )
+        if self.__original_dxf != self.dxf or moved:
+            # old layers are purged once the new extraction is active
+            # preview is regenerated on extraction
+            if self.__original_dxf != self.dxf and self.preview:
+                self.preview.delete(save=False)
             extract_dxf(self, doc=None, refresh=True)
+            # DXF is rewritten by extraction
+            if self.needs_refresh:
+                self.needs_refresh = False
+                Drawing.objects.filter(id=self.id).update(needs_refresh=False)
+        if moved:
+            propagate_georeferencing(self)
 
-    def write_csv(self, writer):
-        writer_data = []
-        layers = self.related_layers.all()
-        for layer in layers:
-            entities = layer.related_entities.exclude(data=None)
-            for e in entities:
-                entity_data = {
-                    "id": e.id,
-                    "layer": layer.name,
-                    "data": e.data,
-                }
-                if e.insertion:
-                    entity_data["Latitude"] = e.insertion["coordinates"][0]
-                    entity_data["Longitude"] = e.insertion["coordinates"][1]
-                writer_data.append(entity_data)
-        writer.writerow(
-            [
-                _("ID"),
-                _("Layer"),
-                _("Block"),
-                _("Name"),
-                _("Surface"),
-                _("Perimeter"),
-                _("Height"),
-                _("Width"),
-                _("Rotation"),
-                _("X scale"),
-                _("Y scale"),
-                _("Latitude"),
-                _("Longitude"),
-                _("Attributes"),
-            ]
+    def csv_entities(self):
+        """Entities with data of active extraction, in CSV order"""
+        return (
+            self.related_entities.filter(
+                has_data=True, layer__version=self.extraction_version
+            )
+            .select_related("layer")
+            .only("id", "drawing", "data", "insertion", "layer__name")
+            .order_by("layer__name", "id")
         )
+
+    @staticmethod
+    def csv_header():
+        return [
+            _("ID"),
+            _("Layer"),
+            _("Block"),
+            _("Name"),
+            _("Surface"),
+            _("Perimeter"),
+            _("Height"),
+            _("Width"),
+            _("Rotation"),
+            _("X scale"),
+            _("Y scale"),
+            _("Latitude"),
+            _("Longitude"),
+            _("Attributes"),
+        ]
+
+    @staticmethod
+    def csv_row(entity):
         keys = [
             "Block",
             "Name",
@@ -259,32 +433,27 @@ class Drawing(models.Model):
             "X scale",
             "Y scale",
         ]
-        for wd in writer_data:
-            row = []
-            row.append(wd["id"])
-            row.append(wd["layer"])
-            for k in keys:
-                if k in wd["data"]:
-                    row.append(wd["data"][k])
-                else:
-                    row.append("")
-            if "Latitude" in wd:
-                row.append(wd["Latitude"])
-            else:
-                row.append("")
-            if "Longitude" in wd:
-                row.append(wd["Longitude"])
-            else:
-                row.append("")
-            if "attributes" in wd["data"]:
-                for attr, value in wd["data"]["attributes"].items():
-                    row.append(attr)
-                    row.append(value)
-            writer.writerow(row)
+        row = [entity.id, entity.layer.name]
+        for k in keys:
+            row.append(entity.data.get(k, ""))
+        if entity.insertion:
+            row.append(entity.insertion["coordinates"][0])
+            row.append(entity.insertion["coordinates"][1])
+        else:
+            row += ["", ""]
+        for attr, value in entity.data.get("attributes", {}).items():
+            row.append(attr)
+            row.append(value)
+        return row
+
+    def write_csv(self, writer):
+        writer.writerow(self.csv_header())
+        for e in self.csv_entities():
+            writer.writerow(self.csv_row(e))
         return writer
 
 
-class Layer(models.Model):
+class Layer(BoundsModel):
 
     drawing = models.ForeignKey(
         Drawing,
@@ -305,18 +474,64 @@ class Layer(models.Model):
         default=False,
         editable=False,
     )
+    version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+    )
     geom = GeometryCollectionField(
         null=True,
     )
+    export = models.FileField(
+        _("GeoJSON export"),
+        max_length=200,
+        upload_to="uploads/djeocad/geometry/",
+        null=True,
+        blank=True,
+        editable=False,
+    )
+
+    objects = LayerQuerySet.as_manager()
 
     class Meta:
         verbose_name = _("Layer")
         verbose_name_plural = _("Layers")
         ordering = ("name",)
+        indexes = [
+            models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="layer_bounds_idx"
+            ),
+            models.Index(
+                fields=["drawing", "is_block"], name="layer_drawing_block_idx"
+            ),
+        ]
+
+    def get_geometry_url(self):
+        """Static export if published, else the geometry endpoint"""
+        if self.export:
+            return self.export.url
+        return reverse("djeocadengine:layer_geometry", kwargs={"pk": self.id})
+
+    def get_feature_collection(self):
+        return {
+            "type": "FeatureCollection",
+            "features": [e.get_feature() for e in self.related_entities.all()],
+        }
+
+    async def aiter_features(self):
+        """Features of layer entities, fetched with the async ORM"""
+        async for e in self.related_entities.all():
+            yield e.get_feature()
 
 
-class Entity(models.Model):
+class Entity(BoundsModel):
 
+    # denormalized from layer, for per drawing queries
+    drawing = models.ForeignKey(
+        Drawing,
+        on_delete=models.CASCADE,
+        related_name="related_entities",
+        editable=False,
+    )
     layer = models.ForeignKey(
         Layer,
         on_delete=models.CASCADE,
@@ -325,6 +540,10 @@ class Entity(models.Model):
     data = models.JSONField(
         null=True,
     )
+    has_data = models.BooleanField(
+        default=False,
+        editable=False,
+    )
     geom = GeometryCollectionField()
     insertion = PointField(
         null=True,
@@ -333,6 +552,19 @@ class Entity(models.Model):
     class Meta:
         verbose_name = _("Entity")
         verbose_name_plural = _("Entities")
+        indexes = [
+            models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="entity_bounds_idx"
+            ),
+            models.Index(fields=["drawing", "layer"], name="entity_drawing_layer_idx"),
+            models.Index(
+                fields=["drawing", "has_data"], name="entity_drawing_data_idx"
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.has_data = self.data is not None
+        super().save(*args, **kwargs)
 
     @property
     def popupContent(self):
@@ -359,8 +591,53 @@ class Entity(models.Model):
             "color": self.layer.color_field,
             "linetype": self.layer.linetype,
             "layer": _("Layer - ") + nh3.clean(self.layer.name),
+            "layer_id": self.layer_id,
         }
 
+    def get_feature(self):
+        return {
+            "type": "Feature",
+            "id": self.id,
+            "geometry": self.geom,
+            "properties": {"popupContent": self.popupContent},
+        }
+
+
+class EntityAttribute(models.Model):
+    """Searchable names and attributes of entities, filled on extraction"""
+
+    drawing = models.ForeignKey(
+        Drawing,
+        on_delete=models.CASCADE,
+        related_name="related_attributes",
+    )
+    entity = models.ForeignKey(
+        Entity,
+        on_delete=models.CASCADE,
+        related_name="related_attributes",
+    )
+    key = models.CharField(
+        _("Key"),
+        max_length=50,
+    )
+    value = models.CharField(
+        _("Value"),
+        max_length=200,
+    )
+    # case folded value, searched by exact match or prefix
+    term = models.CharField(
+        max_length=200,
+        editable=False,
+    )
+
+    class Meta:
+        verbose_name = _("Entity attribute")
+        verbose_name_plural = _("Entity attributes")
+        indexes = [
+            models.Index(fields=["term"], name="attribute_term_idx"),
+            models.Index(fields=["key", "term"], name="attribute_key_term_idx"),
+        ]
+
 
 """
     Collection of utilities
@@ -368,22 +645,234 @@ class Entity(models.Model):
 
 
 def cad2hex(color):
+    from ezdxf import colors
+
     if isinstance(color, tuple):
         return "#{:02x}{:02x}{:02x}".format(color[0], color[1], color[2])
     rgb24 = colors.DXF_DEFAULT_COLORS[color]
     return "#{:06X}".format(rgb24)
 
 
-def get_geo_proxy(entity, matrix, transformer):
-    geo_proxy = geo.proxy(entity)
-    if geo_proxy.geotype == "Polygon":
-        if not shape(geo_proxy).is_valid:
-            return False
-    geo_proxy.wcs_to_crs(matrix)
-    geo_proxy.apply(lambda v: Vec3(transformer.transform(v.x, v.y)))
+class ExtractionStats:
+    """Collects timings and counters while extracting a DXF"""
+
+    def __init__(self):
+        self.timings = {}
+        self.entities = Counter()
+        self.rows = Counter()
+        self.vertices = 0
+        self.invalid_polygons = 0
+        self.repaired_polygons = 0
+        # curve segments, and segments saved by flattening limits
+        self.segments = Counter()
+        self.saved_segments = Counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + perf_counter() - start
+
+    def as_dict(self):
+        return {
+            "timings": {k: round(v, 4) for k, v in self.timings.items()},
+            "entities": dict(self.entities),
+            "vertices": self.vertices,
+            "invalid_polygons": self.invalid_polygons,
+            "repaired_polygons": self.repaired_polygons,
+            "rows": dict(self.rows),
+            "flattening": {
+                "segments": dict(self.segments),
+                "saved": dict(self.saved_segments),
+            },
+        }
+
+
+def curve_span(entity):
+    """Radius and angular span of ARC, CIRCLE and ELLIPSE"""
+    from ezdxf.math import Vec3
+
+    if entity.dxftype() == "CIRCLE":
+        return entity.dxf.radius, tau
+    if entity.dxftype() == "ARC":
+        span = (entity.dxf.end_angle - entity.dxf.start_angle) % 360 or 360
+        return entity.dxf.radius, radians(span)
+    span = (entity.dxf.end_param - entity.dxf.start_param) % tau or tau
+    return Vec3(entity.dxf.major_axis).magnitude, span
+
+
+def count_segments(geo_proxy):
+    return sum(len(ring) - 1 for ring in geo_proxy_rings(geo_proxy.__geo_interface__))
+
+
+def geo_proxy_rings(geometry):
+    """Vertex lists of a GeoJSON line or polygon"""
+    if geometry["type"] == "LineString":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "Polygon":
+        return geometry["coordinates"]
+    return []
+
+
+def flatten_curve(entity, segments, stats):
+    """GeoProxy of a curve, flattened within segment limits"""
+    from ezdxf.addons import geo
+    from ezdxf.math import arc_segment_count
+
+    low, high = segments
+    if entity.dxftype() == "SPLINE":
+        # segment count is about proportional to 1 / sqrt(distance)
+        geo_proxy = geo.proxy(entity, distance=FLATTENING_DISTANCE)
+        count = count_segments(geo_proxy)
+        clamped = max(low, min(count, high))
+        if count and clamped != count:
+            distance = FLATTENING_DISTANCE * (count / clamped) ** 2
+            geo_proxy = geo.proxy(entity, distance=distance)
+            clamped = count_segments(geo_proxy)
+    else:
+        radius, span = curve_span(entity)
+        if radius <= 0:
+            return geo.proxy(entity, distance=FLATTENING_DISTANCE)
+        count = arc_segment_count(radius, span, FLATTENING_DISTANCE)
+        clamped = max(low, min(count, high))
+        # sagitta of a segment spanning span / clamped
+        distance = radius * (1 - cos(span / clamped / 2))
+        geo_proxy = geo.proxy(entity, distance=distance)
+    stats.segments[entity.dxftype()] += clamped
+    stats.saved_segments[entity.dxftype()] += count - clamped
     return geo_proxy
 
 
+def is_convex_ring(ring):
+    """Closed ring turning once in the same direction, hence valid"""
+    points = ring[:-1]
+    if len(points) < 3:
+        return False
+    direction = 0
+    turning = 0
+    for i in range(len(points)):
+        a, b, c = points[i - 1], points[i], points[(i + 1) % len(points)]
+        ux, uy = b[0] - a[0], b[1] - a[1]
+        vx, vy = c[0] - b[0], c[1] - b[1]
+        cross = ux * vy - uy * vx
+        if cross == 0 or cross * direction < 0:
+            return False
+        direction = cross
+        turning += atan2(cross, ux * vx + uy * vy)
+    return abs(abs(turning) - tau) < 1e-6
+
+
+def validate_polygons(proxies, stats):
+    """Checks Polygon proxies all at once, invalid ones are repaired
+    if REPAIR_POLYGONS, else replaced by False"""
+    import numpy
+    import shapely
+    from ezdxf.addons import geo
+    from shapely.geometry import mapping
+
+    pending = []
+    coords = []
+    ring_offsets = [0]
+    polygon_offsets = [0]
+    for i, geo_proxy in enumerate(proxies):
+        if geo_proxy.geotype != "Polygon":
+            continue
+        # same rounded coordinates that are stored
+        rings = geo_proxy.__geo_interface__["coordinates"]
+        # small convex polygons need no further checks
+        if len(rings) == 1 and len(rings[0]) <= CONVEX_CHECK_SIZE:
+            if is_convex_ring(rings[0]):
+                continue
+        for ring in rings:
+            if len(ring) < 4 or ring[0] != ring[-1]:
+                break
+        else:
+            pending.append(i)
+            for ring in rings:
+                coords += [(v[0], v[1]) for v in ring]
+                ring_offsets.append(len(coords))
+            polygon_offsets.append(len(ring_offsets) - 1)
+            continue
+        # degenerate rings
+        stats.invalid_polygons += 1
+        proxies[i] = False
+    if not pending:
+        return proxies
+    polygons = shapely.from_ragged_array(
+        shapely.GeometryType.POLYGON,
+        numpy.array(coords, dtype=float),
+        (numpy.array(ring_offsets), numpy.array(polygon_offsets)),
+    )
+    valid = shapely.is_valid(polygons)
+    for i, polygon, is_valid in zip(pending, polygons, valid):
+        if is_valid:
+            continue
+        stats.invalid_polygons += 1
+        proxies[i] = False
+        if REPAIR_POLYGONS:
+            repaired = shapely.make_valid(polygon)
+            if not repaired.is_empty:
+                stats.repaired_polygons += 1
+                proxies[i] = geo.GeoProxy.parse(mapping(repaired))
+    return proxies
+
+
+def get_geo_proxies(entities, matrix, transformer, stats=None):
+    """GeoProxies of entities in world coordinates, False for
+    invalid polygons"""
+    from ezdxf.addons import geo
+    from ezdxf.math import Vec3
+
+    if stats is None:
+        stats = ExtractionStats()
+    proxies = []
+    with stats.phase("proxy"):
+        for entity in entities:
+            stats.entities[entity.dxftype()] += 1
+            segments = FLATTENING_SEGMENTS.get(entity.dxftype())
+            if segments:
+                proxies.append(flatten_curve(entity, segments, stats))
+            else:
+                proxies.append(geo.proxy(entity, distance=FLATTENING_DISTANCE))
+    with stats.phase("validation"):
+        proxies = validate_polygons(proxies, stats)
+
+    def to_world(v):
+        stats.vertices += 1
+        return Vec3(transformer.transform(v.x, v.y))
+
+    with stats.phase("reprojection"):
+        for geo_proxy in proxies:
+            if geo_proxy:
+                geo_proxy.wcs_to_crs(matrix)
+                geo_proxy.apply(to_world)
+    return proxies
+
+
+def get_geo_proxy(entity, matrix, transformer, stats=None):
+    return get_geo_proxies([entity], matrix, transformer, stats)[0]
+
+
+def insertion_points(inserts, matrix, transformer, stats=None):
+    """Insertion points of INSERTs in world coordinates, transformed
+    all at once without adding entities to the document"""
+    if stats is None:
+        stats = ExtractionStats()
+    if not inserts:
+        return []
+    with stats.phase("reprojection"):
+        points = list(matrix.transform_vertices(ins.dxf.insert for ins in inserts))
+        xs, ys = transformer.transform([p.x for p in points], [p.y for p in points])
+    stats.vertices += len(points)
+    # same precision as GeoProxy.__geo_interface__
+    return [
+        {"type": "Point", "coordinates": (round(x, 6), round(y, 6))}
+        for x, y in zip(xs, ys)
+    ]
+
+
 def get_epsg_xml(drawing):
     xml = """<?xml version="1.0"
 encoding="UTF-16" standalone="no" ?>
@@ -406,15 +895,20 @@ encoding="UTF-16" standalone="no" ?>
 <AxisDirection>north</AxisDirection>
 </CoordinateSystemAxis>
 </Axis>
-</Dictionary>""" % {
-        "epsg": drawing.epsg
-    }
+</Dictionary>""" % {"epsg": drawing.epsg}
     return xml
 
 
+@lru_cache(maxsize=32)
+def get_transformer(crs_from, crs_to):
+    from pyproj import Transformer
+
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
 def prepare_transformers(drawing):
-    world2utm = Transformer.from_crs(4326, drawing.epsg, always_xy=True)
-    utm2world = Transformer.from_crs(drawing.epsg, 4326, always_xy=True)
+    world2utm = get_transformer(4326, drawing.epsg)
+    utm2world = get_transformer(drawing.epsg, 4326)
     utm_wcs = world2utm.transform(
         drawing.geom["coordinates"][0], drawing.geom["coordinates"][1]
     )
@@ -422,6 +916,71 @@ def prepare_transformers(drawing):
     return world2utm, utm2world, utm_wcs, rot
 
 
+def entity_size(entity):
+    """Rough size of entity, cheaper than a bounding box"""
+    from ezdxf.math import Vec3
+
+    e_type = entity.dxftype()
+    if e_type in ["CIRCLE", "ARC"]:
+        return 2 * entity.dxf.radius
+    if e_type == "ELLIPSE":
+        return 2 * Vec3(entity.dxf.major_axis).magnitude
+    if e_type == "LWPOLYLINE":
+        points = entity.get_points("xy")
+    elif e_type == "LINE":
+        points = [entity.dxf.start, entity.dxf.end]
+    elif e_type == "SPLINE":
+        points = entity.control_points or entity.fit_points
+    else:
+        return 0
+    if not len(points):
+        return 0
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return max(max(xs) - min(xs), max(ys) - min(ys))
+
+
+def preview_filter(msp):
+    """Filter of entities drawn in previews of large drawings"""
+    if len(msp) <= PREVIEW_MAX_ENTITIES:
+        return None
+    entities = [e for e in msp if e.dxftype() not in PREVIEW_SKIP_TYPES]
+    entities.sort(key=entity_size, reverse=True)
+    handles = {e.dxf.handle for e in entities[:PREVIEW_MAX_ENTITIES]}
+    return lambda e: e.dxf.handle in handles
+
+
+def make_preview(drawing, doc, stats):
+    """Renders modelspace in a small SVG, stored only if not too big"""
+    from ezdxf.addons.drawing import Frontend, RenderContext, config, layout, svg
+
+    with stats.phase("preview"):
+        msp = doc.modelspace()
+        backend = svg.SVGBackend()
+        Frontend(
+            RenderContext(doc),
+            backend,
+            config=config.Configuration(
+                max_flattening_distance=PREVIEW_FLATTENING,
+                hatch_policy=config.HatchPolicy.SHOW_OUTLINE,
+                text_policy=config.TextPolicy.IGNORE,
+                background_policy=config.BackgroundPolicy.OFF,
+            ),
+        ).draw_layout(msp, finalize=True, filter_func=preview_filter(msp))
+        preview = backend.get_string(
+            layout.Page(256, 192, layout.Units.px),
+            settings=layout.Settings(output_coordinate_space=1000),
+            xml_declaration=False,
+        )
+    if len(preview) > PREVIEW_MAX_SIZE:
+        drawing.preview = None
+    else:
+        drawing.preview.save(
+            f"drawing_{drawing.id}.svg", ContentFile(preview.encode()), save=False
+        )
+    Drawing.objects.filter(id=drawing.id).update(preview=drawing.preview.name)
+
+
 def fake_geodata(drawing, geodata, utm_wcs, rot):
     geodata.coordinate_system_definition = get_epsg_xml(drawing)
     geodata.dxf.design_point = (drawing.designx, drawing.designy, 0)
@@ -430,15 +989,359 @@ def fake_geodata(drawing, geodata, utm_wcs, rot):
     return geodata
 
 
-def extract_dxf(drawing, doc=None, refresh=False):
+def get_crs_matrix(drawing):
+    """WCS to UTM matrix of drawing georeferencing, as used by extraction"""
+    import ezdxf
+
+    world2utm, utm2world, utm_wcs, rot = prepare_transformers(drawing)
+    geodata = ezdxf.new().modelspace().new_geodata()
+    geodata = fake_geodata(drawing, geodata, utm_wcs, rot)
+    m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
+    return m
+
+
+def refresh_geodata(drawing):
+    """Writes current georeferencing in the DXF file"""
+    import ezdxf
+
+    world2utm, utm2world, utm_wcs, rot = prepare_transformers(drawing)
+    doc = ezdxf.readfile(drawing.dxf.path)
+    msp = doc.modelspace()
+    geodata = msp.get_geodata() or msp.new_geodata()
+    fake_geodata(drawing, geodata, utm_wcs, rot)
+    doc.saveas(filename=drawing.dxf.path, encoding="utf-8", fmt="asc")
+    drawing.needs_refresh = False
+    Drawing.objects.filter(id=drawing.id).update(needs_refresh=False)
+
+
+def iter_positions(geometry):
+    """Mutable [x, y] positions of a GeoJSON geometry"""
+    if geometry["type"] == "GeometryCollection":
+        for g in geometry["geometries"]:
+            yield from iter_positions(g)
+        return
+    stack = [geometry["coordinates"]]
+    while stack:
+        coords = stack.pop()
+        if not coords:
+            continue
+        if isinstance(coords[0], (int, float)):
+            yield coords
+        else:
+            stack.extend(coords)
+
+
+def reproject_drawing(drawing, source):
+    """Moves stored geometry of drawing to georeferencing of source,
+    through WCS coordinates, without reading the DXF file"""
+    from ezdxf.math import Matrix44
+
+    if drawing.epsg:
+        world2utm = get_transformer(4326, drawing.epsg)
+        wcs_matrix = get_crs_matrix(drawing)
+        wcs_matrix.inverse()
+    for field in ("geom", "epsg", "designx", "designy", "rotation"):
+        setattr(drawing, field, getattr(source, field))
+    if isinstance(drawing.geom, str):
+        drawing.geom = json.loads(drawing.geom)
+    layers = list(drawing.related_layers.active())
+    entities = list(drawing.related_entities.filter(layer__in=layers))
+    if not drawing.epsg or not entities:
+        return
+    # a single transformation for all positions of the drawing
+    utm_matrix = Matrix44.chain(wcs_matrix, get_crs_matrix(drawing))
+    utm2world = get_transformer(drawing.epsg, 4326)
+    positions = []
+    for obj in layers + entities:
+        if obj.geom:
+            positions += iter_positions(obj.geom)
+        if getattr(obj, "insertion", None):
+            positions += iter_positions(obj.insertion)
+    if positions:
+        xx, yy = world2utm.transform(
+            [p[0] for p in positions], [p[1] for p in positions]
+        )
+        utm = list(utm_matrix.fast_2d_transform(zip(xx, yy)))
+        xx, yy = utm2world.transform([v.x for v in utm], [v.y for v in utm])
+        # same precision as GeoJSON export of extraction
+        for p, x, y in zip(positions, xx, yy):
+            p[0], p[1] = round(x, 6), round(y, 6)
+    # bounds follow geometry
+    layer_bounds = {}
+    for e in entities:
+        geometries = e.geom["geometries"] if e.geom else []
+        if e.insertion:
+            geometries = geometries + [e.insertion]
+        for k, v in bounds_fields(get_bounds(geometries)).items():
+            setattr(e, k, v)
+        layer_bounds[e.layer_id] = merge_bounds(layer_bounds.get(e.layer_id), e.bounds)
+    drawing_bounds = None
+    for layer in layers:
+        bounds = layer_bounds.get(layer.id)
+        if bounds is None and layer.geom:
+            bounds = get_bounds(layer.geom["geometries"])
+        for k, v in bounds_fields(bounds).items():
+            setattr(layer, k, v)
+        if not layer.is_block:
+            drawing_bounds = merge_bounds(drawing_bounds, bounds)
+    for k, v in bounds_fields(drawing_bounds).items():
+        setattr(drawing, k, v)
+    bounds = ["minx", "miny", "maxx", "maxy"]
+    Entity.objects.bulk_update(entities, ["geom", "insertion"] + bounds, 500)
+    Layer.objects.bulk_update(layers, ["geom"] + bounds, 500)
+
+
+# drawing fields read again once the drawing is locked
+EXTRACTION_FIELDS = [
+    "dxf",
+    "geom",
+    "epsg",
+    "designx",
+    "designy",
+    "rotation",
+    "extraction_version",
+    "extraction_key",
+]
+
+
+# drawing fields written by extraction only
+EXTRACTION_STATE = [
+    "extraction_version",
+    "extraction_key",
+    "minx",
+    "miny",
+    "maxx",
+    "maxy",
+    "preview",
+    "export",
+    "extraction_stats",
+    "needs_refresh",
+]
+
+
+def edited_fields():
+    """Drawing fields written when a drawing is saved"""
+    return [
+        f.name
+        for f in Drawing._meta.concrete_fields
+        if not f.primary_key and f.name not in EXTRACTION_STATE
+    ]
+
+
+def next_version(drawing):
+    """Extraction version above any layer of drawing, to be read
+    once the drawing is locked"""
+    latest = drawing.related_layers.aggregate(latest=models.Max("version"))
+    return max(drawing.extraction_version, latest["latest"] or 0) + 1
+
+
+def lock_drawing(drawing):
+    """Waits for extractions or reprojections of drawing running in other
+    transactions, then reads its latest parameters"""
+    locked = Drawing.objects.select_for_update().filter(id=drawing.id)
+    list(locked.values_list("id", flat=True))
+    drawing.refresh_from_db(fields=EXTRACTION_FIELDS)
+
+
+def propagate_georeferencing(parent):
+    """Moves children of parent, and their children, with it: stored
+    coordinates are reprojected and DXF geodata is refreshed on download"""
+    from .spatial import drawing_indexes
+    from .views import invalidate_clusters
+
+    seen = {parent.id}
+    parents = [parent.id]
+    while parents:
+        children = list(
+            Drawing.objects.filter(parent_id__in=parents).exclude(id__in=seen)
+        )
+        parents = []
+        for child in children:
+            seen.add(child.id)
+            parents.append(child.id)
+            with transaction.atomic():
+                lock_drawing(child)
+                reproject_drawing(child, parent)
+                # a new revision, so that hit-test indexes are built again
+                version = next_version(child)
+                child.related_layers.filter(version=child.extraction_version).update(
+                    version=version
+                )
+                child.extraction_version = version
+                child.needs_refresh = True
+                Drawing.objects.filter(id=child.id).update(
+                    extraction_version=version,
+                    geom=child.geom,
+                    epsg=child.epsg,
+                    designx=child.designx,
+                    designy=child.designy,
+                    rotation=child.rotation,
+                    needs_refresh=True,
+                    **bounds_fields(child.bounds),
+                )
+            drawing_indexes.invalidate(child.id)
+            if PUBLISH_GEOMETRY and child.epsg:
+                publish_geometry(child)
+    if len(seen) > 1:
+        # children were moved without saving them
+        invalidate_clusters()
+
+
+def get_bounds(geometries, bounds=None):
+    """Extends bounds (minx, miny, maxx, maxy) with coordinates
+    of geo interfaces, None if there are no coordinates"""
+    for geometry in geometries:
+        if geometry["type"] == "GeometryCollection":
+            bounds = get_bounds(geometry["geometries"], bounds)
+            continue
+        stack = [geometry["coordinates"]]
+        while stack:
+            coords = stack.pop()
+            if not coords:
+                continue
+            if not isinstance(coords[0], (int, float)):
+                stack.extend(coords)
+                continue
+            x, y = coords[0], coords[1]
+            if bounds is None:
+                bounds = (x, y, x, y)
+            else:
+                bounds = (
+                    min(bounds[0], x),
+                    min(bounds[1], y),
+                    max(bounds[2], x),
+                    max(bounds[3], y),
+                )
+    return bounds
+
+
+def merge_bounds(bounds, other):
+    if bounds is None:
+        return other
+    if other is None:
+        return bounds
+    return (
+        min(bounds[0], other[0]),
+        min(bounds[1], other[1]),
+        max(bounds[2], other[2]),
+        max(bounds[3], other[3]),
+    )
+
+
+def bounds_fields(bounds):
+    if bounds is None:
+        bounds = (None, None, None, None)
+    return dict(zip(("minx", "miny", "maxx", "maxy"), bounds))
+
+
+def create_row(model, stats, **kwargs):
+    geometries = []
+    if kwargs.get("geom"):
+        geometries += kwargs["geom"]["geometries"]
+    if kwargs.get("insertion"):
+        geometries.append(kwargs["insertion"])
+    kwargs.update(bounds_fields(get_bounds(geometries)))
+    with stats.phase("db"):
+        obj = model.objects.create(**kwargs)
+    stats.rows[model._meta.model_name] += 1
+    return obj
+
+
+def search_term(value):
+    return str(value).strip().casefold()[:200]
+
+
+def entity_attributes(entity):
+    """Unsaved EntityAttribute rows for names, blocks and attributes"""
+    data = entity.data or {}
+    pairs = [(k, data[k]) for k in ("Name", "Block") if data.get(k)]
+    pairs += list(data.get("attributes", {}).items())
+    return [
+        EntityAttribute(
+            drawing_id=entity.drawing_id,
+            entity_id=entity.id,
+            key=str(key)[:50],
+            value=str(value)[:200],
+            term=search_term(value),
+        )
+        for key, value in pairs
+        if str(value).strip()
+    ]
+
+
+def extraction_key(drawing):
+    """Hash of stored DXF, georeferencing and extraction parameters"""
+    digest = hashlib.sha256()
+    with drawing.dxf.open("rb") as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    params = [
+        drawing.dxf.name,
+        drawing.epsg,
+        drawing.geom["coordinates"],
+        drawing.designx,
+        drawing.designy,
+        drawing.rotation,
+        sorted(drawing.entity_types),
+        sorted(drawing.layer_blacklist),
+        sorted(drawing.name_blacklist),
+        FLATTENING_DISTANCE,
+        FLATTENING_SEGMENTS,
+        REPAIR_POLYGONS,
+    ]
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def extract_dxf(drawing, doc=None, refresh=False, stats=None, force=False):
+    """Extracts layers and entities of DXF in a single transaction.
+    Concurrent extractions of the same drawing wait for a row lock, then
+    run with latest parameters: extraction is skipped if the last
+    completed one had the same extraction_key (i.e. it was queued behind
+    an identical one, or a retried job), unless forced"""
+    if stats is None:
+        stats = ExtractionStats()
+    start = perf_counter()
+    # a crash leaves no partial extraction, and a single transaction
+    # is much faster than committing each row
+    with transaction.atomic():
+        dxf = drawing.dxf.name
+        with stats.phase("lock"):
+            lock_drawing(drawing)
+        # DXF was replaced while waiting
+        if drawing.dxf.name != dxf:
+            doc = None
+        if not extract_rows(drawing, doc, refresh, stats, force):
+            return
+    if PUBLISH_GEOMETRY:
+        with stats.phase("publish"):
+            publish_geometry(drawing)
+    stats.timings["total"] = perf_counter() - start
+    record_stats(drawing, stats)
+
+
+def extract_rows(drawing, doc, refresh, stats, force):
+    """Writes layers and entities of a new extraction version and swaps
+    it with the previous one, returns False if extraction was skipped"""
+    import ezdxf
+    from shapely.geometry import Point, Polygon
+
     # following conditional for test to work
     if isinstance(drawing.geom, str):
         drawing.geom = json.loads(drawing.geom)
+    # the DXF is rewritten by extraction, so a retry finds the stored key
+    key = extraction_key(drawing)
+    if drawing.extraction_key == key and not force:
+        logger.info("Drawing %(id)s already extracted, skipped", {"id": drawing.id})
+        return False
     # prepare transformers
     world2utm, utm2world, utm_wcs, rot = prepare_transformers(drawing)
     # get DXF
     if not doc:
-        doc = ezdxf.readfile(drawing.dxf.path)
+        with stats.phase("parse"):
+            doc = ezdxf.readfile(drawing.dxf.path)
+    if not drawing.preview:
+        make_preview(drawing, doc, stats)
     msp = doc.modelspace()
     geodata = msp.get_geodata()
     if not geodata or refresh:
@@ -446,9 +1349,15 @@ def extract_dxf(drawing, doc=None, refresh=False):
         geodata = msp.new_geodata()
         geodata = fake_geodata(drawing, geodata, utm_wcs, rot)
         # replace stored DXF
-        doc.saveas(filename=drawing.dxf.path, encoding="utf-8", fmt="asc")
+        with stats.phase("write_dxf"):
+            doc.saveas(filename=drawing.dxf.path, encoding="utf-8", fmt="asc")
+        key = extraction_key(drawing)
     # get transform matrix from true or fake geodata
     m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
+    # rows are written under a new version, active when extraction ends
+    version = next_version(drawing)
+    # search index, stored in bulk
+    attributes = []
     # prepare layer table
     layer_table = {}
     for layer in doc.layers:
@@ -458,19 +1367,24 @@ def extract_dxf(drawing, doc=None, refresh=False):
             color = cad2hex(layer.rgb)
         else:
             color = cad2hex(layer.color)
-        layer_obj = Layer.objects.create(
+        layer_obj = create_row(
+            Layer,
+            stats,
             drawing_id=drawing.id,
             name=layer.dxf.name,
             color_field=color,
+            version=version,
         )
         layer_table[layer.dxf.name] = {
             "layer_obj": layer_obj,
             "geometries": [],
+            "bounds": None,
         }
     for e_type in drawing.entity_types:
         # extract entities
-        for e in msp.query(e_type):
-            geo_proxy = get_geo_proxy(e, m, utm2world)
+        entities = list(msp.query(e_type))
+        proxies = get_geo_proxies(entities, m, utm2world, stats)
+        for e, geo_proxy in zip(entities, proxies):
             if geo_proxy:
                 if e_type in ["LWPOLYLINE", "POLYLINE"]:
                     entity_data = {}
@@ -478,18 +1392,19 @@ def extract_dxf(drawing, doc=None, refresh=False):
                     try:
                         poly = Polygon(e.vertices_in_wcs())
                         # look for texts in same layer
-                        for t_type in drawing.text_types:
-                            txts = msp.query(f"{t_type}[layer=='{e.dxf.layer}']")
-                            for t in txts:
-                                point = Point(t.dxf.insert)
-                                # check if text is contained by polygon
-                                if poly.contains(point):
-                                    # handle different type of texts
-                                    if t_type == "TEXT":
-                                        entity_data["Name"] = t.dxf.text
-                                    else:
-                                        entity_data["Name"] = t.text
-                                    break
+                        with stats.phase("text_matching"):
+                            for t_type in drawing.text_types:
+                                txts = msp.query(f"{t_type}[layer=='{e.dxf.layer}']")
+                                for t in txts:
+                                    point = Point(t.dxf.insert)
+                                    # check if text is contained by polygon
+                                    if poly.contains(point):
+                                        # handle different type of texts
+                                        if t_type == "TEXT":
+                                            entity_data["Name"] = t.dxf.text
+                                        else:
+                                            entity_data["Name"] = t.text
+                                        break
                         if e.is_closed:
                             entity_data["Surface"] = round(poly.area, 2)
                         if e.dxf.thickness:
@@ -497,7 +1412,10 @@ def extract_dxf(drawing, doc=None, refresh=False):
                         entity_data["Perimeter"] = round(poly.length, 2)
                         if e.dxf.const_width:
                             entity_data["Width"] = round(e.dxf.const_width, 2)
-                        Entity.objects.create(
+                        entity = create_row(
+                            Entity,
+                            stats,
+                            drawing_id=drawing.id,
                             layer=layer_table[e.dxf.layer]["layer_obj"],
                             geom={
                                 "geometries": [geo_proxy.__geo_interface__],
@@ -505,6 +1423,10 @@ def extract_dxf(drawing, doc=None, refresh=False):
                             },
                             data=entity_data,
                         )
+                        attributes += entity_attributes(entity)
+                        layer_table[e.dxf.layer]["bounds"] = merge_bounds(
+                            layer_table[e.dxf.layer]["bounds"], entity.bounds
+                        )
                     except ValueError:
                         # not true polygon, add to layer entity
                         layer_table[e.dxf.layer]["geometries"].append(
@@ -517,13 +1439,17 @@ def extract_dxf(drawing, doc=None, refresh=False):
                     )
     # create layer entities
     for name, layer_data in layer_table.items():
-        Entity.objects.create(
+        entity = create_row(
+            Entity,
+            stats,
+            drawing_id=drawing.id,
             layer=layer_data["layer_obj"],
             geom={
                 "geometries": layer_data["geometries"],
                 "type": "GeometryCollection",
             },
         )
+        layer_data["bounds"] = merge_bounds(layer_data["bounds"], entity.bounds)
     # save blocks
     for block in doc.blocks:
         if block.name in drawing.name_blacklist:
@@ -531,13 +1457,15 @@ def extract_dxf(drawing, doc=None, refresh=False):
         geometries = []
         for e_type in drawing.entity_types:
             # extract entities
-            for e in block.query(e_type):
-                geo_proxy = get_geo_proxy(e, m, utm2world)
+            proxies = get_geo_proxies(block.query(e_type), m, utm2world, stats)
+            for geo_proxy in proxies:
                 if geo_proxy:
                     geometries.append(geo_proxy.__geo_interface__)
         # create block as Layer
         if not geometries == []:
-            Layer.objects.create(
+            create_row(
+                Layer,
+                stats,
                 drawing_id=drawing.id,
                 name=block.name,
                 geom={
@@ -545,24 +1473,25 @@ def extract_dxf(drawing, doc=None, refresh=False):
                     "type": "GeometryCollection",
                 },
                 is_block=True,
+                version=version,
             )
-    # extract insertions
-    for ins in msp.query("INSERT"):
-        # filter blacklisted blocks
-        if ins.dxf.name in drawing.name_blacklist:
-            continue
-        point = msp.add_point(ins.dxf.insert)
-        geo_proxy = get_geo_proxy(point, m, utm2world)
-        if geo_proxy:
-            insertion_point = geo_proxy.__geo_interface__
+    # extract insertions, filtering blacklisted blocks
+    inserts = [
+        ins for ins in msp.query("INSERT") if ins.dxf.name not in drawing.name_blacklist
+    ]
+    stats.entities["INSERT"] += len(inserts)
+    points = insertion_points(inserts, m, utm2world, stats)
+    for ins, insertion_point in zip(inserts, points):
         geometries = []
         # 'generator' object has no attribute 'query'
-        for e in ins.virtual_entities():
-            if e.dxftype() in drawing.entity_types:
-                # extract entity
-                geo_proxy = get_geo_proxy(e, m, utm2world)
-                if geo_proxy:
-                    geometries.append(geo_proxy.__geo_interface__)
+        with stats.phase("block_explosion"):
+            virtual_entities = list(ins.virtual_entities())
+        virtual_entities = [
+            e for e in virtual_entities if e.dxftype() in drawing.entity_types
+        ]
+        for geo_proxy in get_geo_proxies(virtual_entities, m, utm2world, stats):
+            if geo_proxy:
+                geometries.append(geo_proxy.__geo_interface__)
         # prepare block data
         data_ins = {}
         data_ins["Block"] = ins.dxf.name
@@ -578,7 +1507,10 @@ def extract_dxf(drawing, doc=None, refresh=False):
                 attrib_dict[attr.dxf.tag] = attr.dxf.text
             data_ins["attributes"] = attrib_dict
         # create Insertion
-        Entity.objects.create(
+        entity = create_row(
+            Entity,
+            stats,
+            drawing_id=drawing.id,
             data=data_ins,
             layer=layer_table[ins.dxf.layer]["layer_obj"],
             insertion=insertion_point,
@@ -587,3 +1519,119 @@ def extract_dxf(drawing, doc=None, refresh=False):
                 "type": "GeometryCollection",
             },
         )
+        layer_table[ins.dxf.layer]["bounds"] = merge_bounds(
+            layer_table[ins.dxf.layer]["bounds"], entity.bounds
+        )
+        attributes += entity_attributes(entity)
+    # store layer and drawing bounds, blocks are placed on WCS origin
+    drawing_bounds = None
+    with stats.phase("db"):
+        EntityAttribute.objects.bulk_create(attributes, batch_size=500)
+        stats.rows["entityattribute"] += len(attributes)
+        for layer_data in layer_table.values():
+            if layer_data["bounds"] is None:
+                continue
+            drawing_bounds = merge_bounds(drawing_bounds, layer_data["bounds"])
+            Layer.objects.filter(id=layer_data["layer_obj"].id).update(
+                **bounds_fields(layer_data["bounds"])
+            )
+        for k, v in bounds_fields(drawing_bounds).items():
+            setattr(drawing, k, v)
+        # a single update swaps old and new extraction for readers
+        drawing.extraction_version = version
+        drawing.extraction_key = key
+        Drawing.objects.filter(id=drawing.id).update(
+            extraction_version=version,
+            extraction_key=key,
+            **bounds_fields(drawing_bounds),
+        )
+        purge_layers([drawing.id], keep_version=version)
+    return True
+
+
+def purge_layers(drawing_ids, keep_version=None):
+    """Deletes layers of drawings and their entities with bulk queries,
+    without loading rows. Layers of keep_version are preserved"""
+    if not drawing_ids:
+        return
+    where = "drawing_id IN (%s)" % ", ".join(["%s"] * len(drawing_ids))
+    params = list(drawing_ids)
+    if keep_version is not None:
+        where += " AND version <> %s"
+        params.append(keep_version)
+    layers = Layer.objects.filter(drawing_id__in=drawing_ids)
+    if keep_version is not None:
+        layers = layers.exclude(version=keep_version)
+    exports = list(layers.exclude(export="").values_list("export", flat=True))
+    layer_table = connection.ops.quote_name(Layer._meta.db_table)
+    entity_table = connection.ops.quote_name(Entity._meta.db_table)
+    attribute_table = connection.ops.quote_name(EntityAttribute._meta.db_table)
+    with connection.cursor() as cursor:
+        if keep_version is None:
+            cursor.execute(f"DELETE FROM {attribute_table} WHERE {where}", params)
+            cursor.execute(f"DELETE FROM {entity_table} WHERE {where}", params)
+        else:
+            entities = (
+                f"SELECT id FROM {entity_table} WHERE layer_id IN "
+                f"(SELECT id FROM {layer_table} WHERE {where})"
+            )
+            cursor.execute(
+                f"DELETE FROM {attribute_table} WHERE entity_id IN ({entities})",
+                params,
+            )
+            cursor.execute(
+                f"DELETE FROM {entity_table} WHERE layer_id IN "
+                f"(SELECT id FROM {layer_table} WHERE {where})",
+                params,
+            )
+        cursor.execute(f"DELETE FROM {layer_table} WHERE {where}", params)
+    storage = Layer._meta.get_field("export").storage
+
+    def delete_exports():
+        for name in exports:
+            if name:
+                storage.delete(name)
+
+    # files are still needed if the transaction is rolled back
+    transaction.on_commit(delete_exports)
+
+
+def publish_export(instance, prefix, collection):
+    """Stores collection as a content hashed file, so that it can be
+    cached forever, and removes the previous one"""
+    content = dumps_geojson(collection)
+    digest = hashlib.md5(content).hexdigest()[:12]
+    name = f"{prefix}_{instance.id}_{digest}.json"
+    if instance.export and os.path.basename(instance.export.name) == name:
+        return
+    if instance.export:
+        instance.export.delete(save=False)
+    instance.export.save(name, ContentFile(content), save=False)
+    type(instance).objects.filter(id=instance.id).update(export=instance.export.name)
+
+
+def publish_geometry(drawing):
+    """Publishes drawing and layer geometry in MEDIA_ROOT, call it
+    when entities or layer styles change"""
+    layers = drawing.related_layers.filter(
+        version=drawing.extraction_version, is_block=False
+    )
+    for layer in layers.defer("geom"):
+        publish_export(layer, "layer", layer.get_feature_collection())
+    publish_export(drawing, "drawing", drawing.get_feature_collection())
+
+
+def record_stats(drawing, stats):
+    """Stores extraction stats, then logs them and sends the signal"""
+    drawing.extraction_stats = stats.as_dict()
+    Drawing.objects.filter(id=drawing.id).update(
+        extraction_stats=drawing.extraction_stats
+    )
+    logger.info(
+        "Drawing %(id)s extracted in %(total)ss",
+        {"id": drawing.id, "total": drawing.extraction_stats["timings"]["total"]},
+        extra={"extraction_stats": drawing.extraction_stats},
+    )
+    extraction_finished.send(
+        sender=Drawing, drawing=drawing, stats=drawing.extraction_stats
+    )
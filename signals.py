@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# sent by extract_dxf with "drawing" and "stats" arguments
+extraction_finished = Signal()
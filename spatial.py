@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from shapely import STRtree
+from shapely.geometry import LineString, Point, Polygon, mapping, shape
+
+from .models import Entity
+
+# number of drawing indexes kept in process memory
+HIT_TEST_CACHE_SIZE = getattr(settings, "CAD_HIT_TEST_CACHE_SIZE", 32)
+# search radius around the point, in degrees (about 1 m)
+HIT_TEST_TOLERANCE = getattr(settings, "CAD_HIT_TEST_TOLERANCE", 0.00001)
+
+
+def entity_shapes(geom):
+    """Shapes of an entity geometry collection, closed lines become
+    polygons so that points inside rooms hit them"""
+    shapes = []
+    for geometry in geom["geometries"]:
+        s = shape(geometry)
+        if isinstance(s, LineString) and s.is_ring:
+            s = Polygon(s.coords)
+        shapes.append(s)
+    return shapes
+
+
+def simplify_geometry(geom, tolerance):
+    """Geometry collection simplified to tolerance, geometries smaller
+    than tolerance are dropped"""
+    geometries = []
+    for geometry in geom["geometries"]:
+        s = shape(geometry)
+        if s.geom_type != "Point":
+            minx, miny, maxx, maxy = s.bounds
+            if max(maxx - minx, maxy - miny) < tolerance:
+                continue
+            s = s.simplify(tolerance, preserve_topology=False)
+            if s.is_empty:
+                continue
+        geometries.append(mapping(s))
+    return {"type": "GeometryCollection", "geometries": geometries}
+
+
+class DrawingIndex:
+    """STRtree of the entities with data of a drawing extraction"""
+
+    def __init__(self, drawing):
+        self.version = drawing.extraction_version
+        self.entities = []
+        shapes = []
+        entities = drawing.related_entities.filter(
+            has_data=True, layer__version=drawing.extraction_version
+        ).values_list("id", "layer_id", "geom", "insertion")
+        for pk, layer_id, geom, insertion in entities:
+            items = entity_shapes(geom)
+            if insertion:
+                items.append(shape(insertion))
+            for item in items:
+                shapes.append(item)
+                self.entities.append((pk, layer_id))
+        self.tree = STRtree(shapes)
+
+    def query(self, point, tolerance=HIT_TEST_TOLERANCE, layers=None):
+        """Ids of entities hit by point, in layers if provided"""
+        hits = self.tree.query(point.buffer(tolerance), predicate="intersects")
+        found = []
+        for i in sorted(hits):
+            pk, layer_id = self.entities[i]
+            if layers and layer_id not in layers:
+                continue
+            if pk not in found:
+                found.append(pk)
+        return found
+
+
+class IndexCache:
+    """LRU cache of drawing indexes, rebuilt when extraction version changes"""
+
+    def __init__(self, size=HIT_TEST_CACHE_SIZE):
+        self.size = size
+        self.indexes = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, drawing):
+        with self.lock:
+            index = self.indexes.get(drawing.id)
+            if index and index.version == drawing.extraction_version:
+                self.indexes.move_to_end(drawing.id)
+                return index
+        # build outside the lock, concurrent builds are harmless
+        index = DrawingIndex(drawing)
+        with self.lock:
+            self.indexes[drawing.id] = index
+            self.indexes.move_to_end(drawing.id)
+            while len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+        return index
+
+    def invalidate(self, drawing_id):
+        with self.lock:
+            self.indexes.pop(drawing_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+
+
+drawing_indexes = IndexCache()
+
+
+def hit_test(drawings, long, lat, layers=None, tolerance=HIT_TEST_TOLERANCE):
+    """Entities of drawings at given point"""
+    point = Point(long, lat)
+    ids = []
+    for drawing in drawings:
+        ids += drawing_indexes.get(drawing).query(point, tolerance, layers)
+    entities = (
+        Entity.objects.select_related("layer").defer("geom", "layer__geom").in_bulk(ids)
+    )
+    return [entities[pk] for pk in ids if pk in entities]
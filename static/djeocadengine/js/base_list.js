@@ -1,4 +1,5 @@
-const map = L.map('engine-map');
+// canvas renderer keeps pan / zoom smooth with many features
+const map = L.map('engine-map', {preferCanvas: true});
 
 function onEachFeature(feature, layer) {
   if (feature.properties && feature.properties.popupContent) {
@@ -18,52 +19,257 @@ const base_map = L.tileLayer("https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png
   {
     attribution: 'Map data &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors',
     maxZoom: 19,
-  });
+  }).addTo(map);
 
 const layer_control = L.control.layers(null).addTo(map);
 const marker_layer = L.layerGroup().addTo(map);
+const click_layer = L.layerGroup().addTo(map);
+// rendered markers and CAD layers, keyed by drawing / layer id
+const markers = new Map();
+const overlays = new Map();
+// raw JSON of last render, unchanged data is not parsed again
+const rendered = {};
+// clustered markers are fetched from server if url is provided
+let marker_url = null;
+let marker_request = 0;
 
-function getCollections() {
-  // add eventually inactive base layers so they can be removed
-  base_map.addTo(map);
-  // sat_map.addTo(map);
-  // remove all layers from layer control and from map
-  map.eachLayer(function (layer) {
-    layer_control.removeLayer(layer);
-    map.removeLayer(layer);
+function readData(id) {
+  let text = document.getElementById(id).textContent;
+  if (rendered[id] === text) {
+    return undefined;
+  }
+  rendered[id] = text;
+  return JSON.parse(text);
+}
+
+function markerKey(marker) {
+  let c = marker.geometry.coordinates;
+  let p = marker.properties;
+  return [marker.id || p.id, c[0], c[1], p.count, p.popupContent && p.popupContent.content].join("|");
+}
+
+function newMarker(marker) {
+  if (marker.properties.count > 1) {
+    let latlng = L.latLng(marker.geometry.coordinates[1], marker.geometry.coordinates[0]);
+    return L.marker(latlng, {icon: L.divIcon({
+      html: marker.properties.count,
+      className: "badge rounded-pill bg-primary",
+      iconSize: [30, 30],
+    })}).on("click", function () {
+      map.setView(latlng, map.getZoom() + 2);
+    });
+  }
+  return L.geoJson(marker, {onEachFeature: onEachFeature});
+}
+
+function updateMarkers(features) {
+  // add new markers, then remove those that disappeared
+  let keys = new Set();
+  for (let marker of features) {
+    let key = markerKey(marker);
+    keys.add(key);
+    if (!markers.has(key)) {
+      markers.set(key, newMarker(marker).addTo(marker_layer));
+    }
+  }
+  for (let [key, layer] of markers) {
+    if (!keys.has(key)) {
+      marker_layer.removeLayer(layer);
+      markers.delete(key);
+    }
+  }
+}
+
+function loadMarkers() {
+  if (!marker_url) {
+    return;
+  }
+  let b = map.getBounds();
+  let params = new URLSearchParams({
+    zoom: map.getZoom(),
+    bbox: [b.getWest(), b.getSouth(), b.getEast(), b.getNorth()].join(","),
+  });
+  let request = ++marker_request;
+  fetch(marker_url + "?" + params).then(response => response.json()).then(function (collection) {
+    // discard responses of previous map moves or pages
+    if (request === marker_request && marker_url) {
+      updateMarkers(collection.features);
+    }
+  });
+}
+
+map.on("moveend", loadMarkers);
+
+// names of CAD layers switched off by the user, not downloaded
+const hidden = new Set(JSON.parse(localStorage.getItem("djeocadengine_hidden") || "[]"));
+
+function overlayKey(layer) {
+  return [layer.id, layer.color, layer.linetype].join("|");
+}
+
+// binary geometry: magic, header length, JSON header where coordinates
+// are replaced by their counts, then delta encoded Int32 coordinates
+const BINARY_TYPE = "application/x-djeocad-geometry";
+
+function decodeGeometry(buffer) {
+  let length = new DataView(buffer).getUint32(4, true);
+  let header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, length)));
+  let values = new Int32Array(buffer, 8 + length);
+  let i = 0, x = 0, y = 0;
+  function next() {
+    x += values[i++];
+    y += values[i++];
+    return [x / header.scale, y / header.scale];
+  }
+  function walk(c) {
+    if (Array.isArray(c)) {
+      return c.map(walk);
+    }
+    let coords = [];
+    for (let n = 0; n < c; n++) {
+      coords.push(next());
+    }
+    return coords;
+  }
+  function geometry(g) {
+    if (g.type === "GeometryCollection") {
+      return {type: g.type, geometries: g.geometries.map(geometry)};
+    }
+    let coordinates = walk(g.coordinates);
+    return {type: g.type, coordinates: g.type === "Point" ? coordinates[0] : coordinates};
+  }
+  for (let feature of header.features) {
+    if (feature.geometry) {
+      feature.geometry = geometry(feature.geometry);
+    }
+  }
+  // other members of the collection, i.e. truncated
+  let collection = Object.assign({}, header, {type: "FeatureCollection"});
+  delete collection.scale;
+  return collection;
+}
+
+function fetchGeometry(url) {
+  return fetch(url, {headers: {"Accept": BINARY_TYPE}}).then(function (response) {
+    if (response.headers.get("Content-Type") === BINARY_TYPE) {
+      return response.arrayBuffer().then(decodeGeometry);
+    }
+    return response.json();
+  });
+}
+
+function loadOverlay(overlay) {
+  if (overlay.loaded) {
+    return;
+  }
+  overlay.loaded = true;
+  fetchGeometry(overlay.url).then(function (collection) {
+    overlay.layer.addData(collection);
   });
-  marker_layer.clearLayers();
-  // add base layers back to map and layer control
-  base_map.addTo(map);
-  // add layer groups
-  collection = JSON.parse(document.getElementById("layer_data").textContent);
-  if (collection !== null) {
-    for (layer_name of collection) {
-      window[layer_name] = L.layerGroup().addTo(map);
-      layer_control.addOverlay(window[layer_name], layer_name);
+}
+
+// geometry of all drawings in view, on list map at high zoom
+const viewport_layer = L.geoJson(null, {style: setLineStyle, onEachFeature: onEachFeature}).addTo(map);
+let viewport = null;
+let viewport_request = 0;
+
+function loadViewport() {
+  let request = ++viewport_request;
+  if (!viewport || map.getZoom() < viewport.min_zoom) {
+    viewport_layer.clearLayers();
+    return;
+  }
+  let b = map.getBounds();
+  let params = new URLSearchParams({
+    zoom: map.getZoom(),
+    bbox: [b.getWest(), b.getSouth(), b.getEast(), b.getNorth()].join(","),
+  });
+  fetchGeometry(viewport.url + "?" + params).then(function (collection) {
+    // discard responses of previous map moves or pages
+    if (request === viewport_request && viewport) {
+      viewport_layer.clearLayers();
+      viewport_layer.addData(collection);
     }
+  });
+}
+
+map.on("moveend", loadViewport);
+
+function updateOverlays(layer_list) {
+  // remove layers that disappeared or changed
+  let keys = new Map();
+  for (let layer of layer_list || []) {
+    keys.set(layer.name, layer);
+  }
+  for (let [name, overlay] of overlays) {
+    if (!keys.has(name) || overlayKey(keys.get(name)) !== overlay.key) {
+      layer_control.removeLayer(overlay.layer);
+      map.removeLayer(overlay.layer);
+      overlays.delete(name);
+    }
+  }
+  // add new layers, one GeoJSON layer each, loaded only if visible
+  for (let [name, layer] of keys) {
+    if (overlays.has(name)) {
+      continue;
+    }
+    let overlay = {
+      key: overlayKey(layer),
+      url: layer.url,
+      loaded: false,
+      layer: L.geoJson(null, {style: setLineStyle, onEachFeature: onEachFeature}),
+    };
+    overlays.set(name, overlay);
+    if (!hidden.has(name)) {
+      overlay.layer.addTo(map);
+      loadOverlay(overlay);
+    }
+    layer_control.addOverlay(overlay.layer, name);
+  }
+}
+
+map.on("overlayadd", function (e) {
+  hidden.delete(e.name);
+  localStorage.setItem("djeocadengine_hidden", JSON.stringify(Array.from(hidden)));
+  if (overlays.has(e.name)) {
+    loadOverlay(overlays.get(e.name));
+  }
+});
+
+map.on("overlayremove", function (e) {
+  hidden.add(e.name);
+  localStorage.setItem("djeocadengine_hidden", JSON.stringify(Array.from(hidden)));
+});
+
+function getCollections() {
+  click_layer.clearLayers();
+  // markers are loaded on map move if url is provided
+  marker_url = JSON.parse(document.getElementById("marker_url").textContent);
+  marker_request++;
+  viewport = JSON.parse(document.getElementById("viewport").textContent) || null;
+  map.whenReady(loadViewport);
+  let collection = readData("marker_data");
+  if (collection !== undefined) {
+    updateMarkers(collection === null ? [] : collection.features);
+  }
+  let layer_list = readData("layer_data");
+  if (layer_list !== undefined) {
+    updateOverlays(layer_list);
   }
-  marker_layer.addTo(map)
-  // add objects to layers
-  collection = JSON.parse(document.getElementById("marker_data").textContent);
-  for (marker of collection.features) {
-    // let author = marker.properties.popupContent.layer
-    L.geoJson(marker, {onEachFeature: onEachFeature}).addTo(marker_layer);
+  // fit bounds only if something changed, drawing extents are computed on extraction
+  let bounds = readData("bounds");
+  if (bounds === undefined && collection === undefined) {
+    return;
   }
-  // fit bounds
-  if (collection.features.length !== 0) {
-    map.fitBounds(L.geoJson(collection).getBounds(), {padding: [30,30]});
+  bounds = JSON.parse(rendered["bounds"]);
+  if (bounds) {
+    map.fitBounds(bounds, {padding: [30,30]});
+  } else if (markers.size !== 0 && !marker_url) {
+    map.fitBounds(L.featureGroup(Array.from(markers.values())).getBounds(), {padding: [30,30]});
   } else {
     let lc = JSON.parse(document.getElementById("leaflet_config").textContent);
     map.setView(lc.DEFAULT_CENTER, lc.DEFAULT_ZOOM)
   }
-  collection = JSON.parse(document.getElementById("line_data").textContent);
-  if (collection !== null) {
-    for (line of collection.features) {
-      let name = line.properties.popupContent.layer
-      L.geoJson(line, {style: setLineStyle, onEachFeature: onEachFeature}).addTo(window[name]);
-    }
-  }
 }
 
 getCollections()
@@ -83,8 +289,12 @@ function onMapClick(e) {
     var inputlong = document.getElementById("id_long");
     inputlat.setAttribute('value', e.latlng.lat);
     inputlong.setAttribute('value', e.latlng.lng);
+    // drawing markers are rendered again on next refresh
     marker_layer.clearLayers();
-    L.marker([e.latlng.lat, e.latlng.lng]).addTo(marker_layer)
+    markers.clear();
+    delete rendered["marker_data"];
+    click_layer.clearLayers();
+    L.marker([e.latlng.lat, e.latlng.lng]).addTo(click_layer)
   }
 }
 
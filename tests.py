@@ -1,17 +1,80 @@
+import csv
+import gzip
+import io
+import json
+import struct
+import tempfile
 from pathlib import Path
+from unittest.mock import patch
 
+import ezdxf
+from asgiref.sync import async_to_sync, sync_to_async
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from ezdxf.addons import geo
+from ezdxf.math import Matrix44
 from users.models import User
 
 from .forms import DrawingManualForm, DrawingUpdateForm
-from .models import Drawing, Layer
+from .management.commands.djeocad_benchmark import make_synthetic_dxf, measure_startup
+from .middleware import request_metrics
+from .models import (
+    FLATTENING_SEGMENTS,
+    Drawing,
+    Entity,
+    EntityAttribute,
+    ExtractionStats,
+    Layer,
+    count_segments,
+    extract_dxf,
+    extraction_key,
+    flatten_curve,
+    get_geo_proxy,
+    get_transformer,
+    insertion_points,
+    preview_filter,
+    propagate_georeferencing,
+    validate_polygons,
+)
+from .signals import extraction_finished
+from .spatial import IndexCache, drawing_indexes, entity_shapes
+from .views import get_cluster_key, invalidate_clusters
 
 pword = settings.DJANGO_SUPERUSER_PASSWORD
 
 
+def streamed(response):
+    """Content of a streaming response of an async view"""
+
+    async def join():
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    return async_to_sync(join)()
+
+
+def make_drawing(title, **kwargs):
+    """Saves a drawing of the test DXF (unless dxf is given), placed
+    in Rome unless geom or parent are given"""
+    path = Path(settings.BASE_DIR).joinpath(
+        "djeocadengine/static/djeocadengine/tests/nogeo.dxf"
+    )
+    if "parent" not in kwargs:
+        kwargs.setdefault("geom", {"type": "Point", "coordinates": [12.0, 42.0]})
+    if "dxf" not in kwargs:
+        kwargs["dxf"] = SimpleUploadedFile(
+            "nogeo.dxf", path.read_bytes(), "image/x-dxf"
+        )
+    draw = Drawing(title=title, **kwargs)
+    draw.save()
+    return draw
+
+
 @override_settings(MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("tests"))
 class GeoCADViewsTest(TestCase):
     @classmethod
@@ -39,13 +102,14 @@ class GeoCADViewsTest(TestCase):
     def tearDown(self):
         """Checks existing files, then removes them.
         Not working for filer paths"""
-        try:
-            path = Path(settings.MEDIA_ROOT).joinpath("uploads/djeocad/dxf/")
-            list = [e for e in path.iterdir() if e.is_file()]
-            for file in list:
-                Path(file).unlink()
-        except FileNotFoundError:
-            pass
+        for folder in ["dxf", "preview", "geometry"]:
+            try:
+                path = Path(settings.MEDIA_ROOT).joinpath(f"uploads/djeocad/{folder}/")
+                list = [e for e in path.iterdir() if e.is_file()]
+                for file in list:
+                    Path(file).unlink()
+            except FileNotFoundError:
+                pass
 
     def test_unlogged_list_status_code(self):
         response = self.client.get(reverse("djeocadengine:base_list"))
@@ -236,6 +300,15 @@ class GeoCADViewsTest(TestCase):
             status_code=302,
             target_status_code=200,
         )
+        self.assertTrue(draw.thumbnail_url)
+        self.assertTrue(draw.preview.name.endswith(".svg"))
+        self.assertIn(draw.thumbnail_url, draw.popupContent["content"])
+        # drawings saved before thumbnails were stored
+        thumbnail_url = draw.thumbnail_url
+        Drawing.objects.filter(id=draw.id).update(thumbnail_url="")
+        call_command("djeocad_thumbnails", stdout=io.StringIO())
+        draw.refresh_from_db()
+        self.assertEqual(draw.thumbnail_url, thumbnail_url)
         response = self.client.get(
             reverse("djeocadengine:drawing_manual", kwargs={"pk": draw.id}),
             headers={"HX-Request": "true"},
@@ -328,3 +401,621 @@ class GeoCADViewsTest(TestCase):
             }
         )
         self.assertFalse(form.is_valid())
+
+    def test_extraction_stats(self):
+        received = []
+
+        def receiver(sender, drawing, stats, **kwargs):
+            received.append(stats)
+
+        extraction_finished.connect(receiver)
+        with self.assertLogs("djeocadengine.models", level="INFO"):
+            draw = make_drawing("Stats")
+        extraction_finished.disconnect(receiver)
+        draw.refresh_from_db()
+        self.assertEqual(received, [draw.extraction_stats])
+        self.assertIn("total", draw.extraction_stats["timings"])
+        self.assertEqual(
+            draw.extraction_stats["rows"]["layer"],
+            Layer.objects.filter(drawing=draw).count(),
+        )
+        self.assertEqual(
+            draw.extraction_stats["rows"]["entity"],
+            Entity.objects.filter(drawing=draw).count(),
+        )
+        self.assertEqual(
+            Entity.objects.filter(drawing=draw, has_data=True).count(),
+            Entity.objects.filter(drawing=draw).exclude(data=None).count(),
+        )
+
+    def test_benchmark_command(self):
+        media = Path(settings.MEDIA_ROOT)
+        # upload folders may be created, files must not be left
+        files = {p for p in media.rglob("*") if p.is_file()}
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp).joinpath("bench.json")
+            call_command(
+                "djeocad_benchmark",
+                "--sizes",
+                "20",
+                "--output",
+                output,
+                stderr=io.StringIO(),
+            )
+            results = json.loads(output.read_text())
+        run = results["runs"][0]
+        self.assertEqual(run["entities"], 20)
+        self.assertGreater(run["rows"], 0)
+        self.assertIn("detail", run)
+        self.assertFalse(Drawing.objects.filter(title="Benchmark 20").exists())
+        self.assertEqual({p for p in media.rglob("*") if p.is_file()} - files, set())
+        # startup does not load CAD / geo libraries
+        self.assertGreater(results["startup"]["imports"], 0)
+        self.assertEqual(results["startup"]["heavy_modules"], [])
+        # libraries imported by other modules are found too
+        importtime = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       300 |        300 |     numpy.core\n"
+            "import time:       200 |        500 |   numpy\n"
+            "import time:       100 |        600 | djeocadengine.urls\n"
+        )
+        with patch("subprocess.run") as run:
+            run.return_value.stderr = importtime
+            startup = measure_startup()
+        self.assertEqual(startup, {"imports": 0.0006, "heavy_modules": ["numpy"]})
+
+    @override_settings(
+        MIDDLEWARE=settings.MIDDLEWARE
+        + ["djeocadengine.middleware.ServerTimingMiddleware"]
+    )
+    def test_server_timing_middleware(self):
+        request_metrics.clear()
+        response = self.client.get(reverse("djeocadengine:base_list"))
+        self.assertIn("sql;dur=", response["Server-Timing"])
+        self.assertIn("render;dur=", response["Server-Timing"])
+        response = self.client.get(reverse("djeocadengine:metrics"))
+        self.assertEqual(response.status_code, 404)
+        self.client.login(username="boss", password=pword)
+        response = self.client.get(reverse("djeocadengine:metrics"))
+        self.assertEqual(response.json()["base_list"]["count"], 1)
+        # streamed responses are measured once consumed
+        draw = make_drawing("Streamed")
+        bbox = ",".join(str(v) for v in draw.bounds)
+        url = reverse("djeocadengine:viewport_geometry")
+        response = self.client.get(url, {"zoom": 22, "bbox": bbox})
+        self.assertIn('size;desc="0 bytes"', response["Server-Timing"])
+        self.assertNotIn("viewport_geometry", request_metrics.aggregates())
+        content = streamed(response)
+        sample = request_metrics.aggregates()["viewport_geometry"]
+        self.assertEqual(sample["bytes"]["max"], len(content))
+        self.assertGreater(sample["queries"]["max"], 0)
+
+    @override_settings(
+        MIDDLEWARE=settings.MIDDLEWARE
+        + ["djeocadengine.middleware.ServerTimingMiddleware"]
+    )
+    async def test_server_timing_middleware_async(self):
+        request_metrics.clear()
+        response = await self.async_client.get(reverse("djeocadengine:base_list"))
+        self.assertIn("sql;dur=", response["Server-Timing"])
+        self.assertNotIn('"0 queries"', response["Server-Timing"])
+        sample = request_metrics.aggregates()["base_list"]
+        self.assertEqual(sample["count"], 1)
+        self.assertGreater(sample["queries"]["max"], 0)
+        # queries run while streaming are counted too
+        draw = await sync_to_async(make_drawing)("Async stream")
+        bbox = ",".join(str(v) for v in draw.bounds)
+        response = await self.async_client.get(
+            reverse("djeocadengine:viewport_geometry"), {"zoom": 22, "bbox": bbox}
+        )
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        sample = request_metrics.aggregates()["viewport_geometry"]
+        self.assertEqual(sample["bytes"]["max"], len(content))
+        self.assertIn('"1 queries"', response["Server-Timing"])
+        self.assertGreater(sample["queries"]["max"], 1)
+
+    def test_bounds(self):
+        drawings = [make_drawing(title) for title in ["Floor 1", "Floor 2"]]
+        minx, miny, maxx, maxy = drawings[0].bounds
+        self.assertTrue(minx <= maxx and miny <= maxy)
+        self.assertAlmostEqual(minx, 12.0, places=1)
+        self.assertAlmostEqual(miny, 42.0, places=1)
+        for layer in Layer.objects.filter(drawing=drawings[0], is_block=False):
+            if layer.bounds:
+                self.assertTrue(layer.minx >= minx and layer.maxy <= maxy)
+        self.assertIn(drawings[1], drawings[0].get_overlapping())
+        response = self.client.get(
+            reverse("djeocadengine:base_list"),
+            {"bbox": f"{minx},{miny},{maxx},{maxy}"},
+        )
+        self.assertEqual(len(response.context["drawings"]), 2)
+        response = self.client.get(
+            reverse("djeocadengine:base_list"), {"bbox": "0,0,1,1"}
+        )
+        self.assertEqual(len(response.context["drawings"]), 0)
+
+    def test_drawing_markers(self):
+        invalidate_clusters()
+        response = self.client.get(
+            reverse("djeocadengine:drawing_markers"),
+            {"zoom": 5, "bbox": "11,41,13,43"},
+        )
+        features = response.json()["features"]
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["properties"]["count"], 2)
+        response = self.client.get(
+            reverse("djeocadengine:drawing_markers"),
+            {"zoom": 18, "bbox": "11,41,13,43"},
+        )
+        features = response.json()["features"]
+        self.assertEqual(len(features), 2)
+        self.assertIn("popupContent", features[0]["properties"])
+        response = self.client.get(
+            reverse("djeocadengine:drawing_markers"),
+            {"zoom": 18, "bbox": "0,0,1,1"},
+        )
+        self.assertEqual(response.json()["features"], [])
+        response = self.client.get(reverse("djeocadengine:base_list"))
+        self.assertEqual(response.context["unreferenced"].number, 1)
+        self.assertEqual(
+            response.context["marker_url"], reverse("djeocadengine:drawing_markers")
+        )
+
+    def test_layer_geometry(self):
+        draw = make_drawing("Layers")
+        response = self.client.get(
+            reverse("djeocadengine:drawing_detail", kwargs={"pk": draw.id})
+        )
+        layer_list = response.context["layer_list"]
+        lay = Layer.objects.get(drawing=draw, name="one")
+        self.assertIn(lay.export.url, [layer["url"] for layer in layer_list])
+        with lay.export.open() as f:
+            self.assertEqual(
+                json.load(f)["features"],
+                json.loads(json.dumps(lay.get_feature_collection()["features"])),
+            )
+        # content hashed name changes with layer style
+        name = lay.export.name
+        lay.color_field = "#00FF00"
+        lay.save()
+        call_command("djeocad_publish", draw.id, stdout=io.StringIO())
+        lay.refresh_from_db()
+        self.assertNotEqual(lay.export.name, name)
+        self.assertFalse(lay.export.storage.exists(name))
+        draw.refresh_from_db()
+        self.assertTrue(draw.export)
+        response = self.client.get(
+            reverse("djeocadengine:layer_geometry", kwargs={"pk": lay.id})
+        )
+        self.assertTrue(response.streaming)
+        collection = json.loads(streamed(response))
+        self.assertEqual(collection["type"], "FeatureCollection")
+        self.assertEqual(
+            collection["features"],
+            json.loads(json.dumps(lay.get_feature_collection()["features"])),
+        )
+        response = self.client.get(
+            reverse("djeocadengine:layer_geometry", kwargs={"pk": lay.id}),
+            headers={"If-None-Match": response["ETag"]},
+        )
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            reverse("djeocadengine:layer_geometry", kwargs={"pk": lay.id}),
+            headers={
+                "Accept": "application/x-djeocad-geometry",
+                "Accept-Encoding": "gzip, deflate",
+            },
+        )
+        self.assertEqual(response["Content-Type"], "application/x-djeocad-geometry")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertTrue(response["ETag"].endswith('-bin-gzip"'))
+        content = gzip.decompress(response.content)
+        self.assertEqual(content[:4], b"DJG1")
+        length = struct.unpack("<I", content[4:8])[0]
+        header = json.loads(content[8 : 8 + length])
+        self.assertEqual(header["scale"], 10**7)
+        self.assertEqual(len(header["features"]), lay.related_entities.count())
+        self.assertEqual((len(content) - 8 - length) % 8, 0)
+
+    def test_streaming_downloads(self):
+        draw = make_drawing("Streams")
+        response = self.client.get(
+            reverse("djeocadengine:drawing_csv", kwargs={"pk": draw.id})
+        )
+        self.assertTrue(response.streaming)
+        output = io.StringIO()
+        # a single query, whatever the number of rows
+        self.assertGreater(draw.csv_entities().count(), 1)
+        with self.assertNumQueries(1):
+            draw.write_csv(csv.writer(output))
+        self.assertEqual(streamed(response).decode(), output.getvalue())
+        response = self.client.get(
+            reverse("djeocadengine:drawing_download", kwargs={"pk": draw.id})
+        )
+        with draw.dxf.open("rb") as f:
+            self.assertEqual(streamed(response), f.read())
+        lay = Layer.objects.get(drawing=draw, name="one")
+        response = self.client.get(
+            reverse("djeocadengine:layer_geometry", kwargs={"pk": lay.id}),
+            headers={"Accept-Encoding": "gzip"},
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        collection = json.loads(gzip.decompress(streamed(response)))
+        self.assertEqual(len(collection["features"]), lay.related_entities.count())
+        response = self.client.get(
+            reverse("djeocadengine:layer_geometry", kwargs={"pk": 0})
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_geometry_deferred(self):
+        draw = make_drawing("Deferred")
+        lay = Layer.objects.get(drawing=draw, name="one")
+        self.client.login(username="boss", password=pword)
+        urls = [
+            reverse("djeocadengine:drawing_detail", kwargs={"pk": draw.id}),
+            reverse("djeocadengine:drawing_update", kwargs={"pk": draw.id}),
+            reverse("djeocadengine:layer_detail", kwargs={"pk": lay.id}),
+            reverse("djeocadengine:layer_update", kwargs={"pk": lay.id}),
+            reverse("djeocadengine:drawing_csv", kwargs={"pk": draw.id}),
+        ]
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, headers={"HX-Request": "true"})
+                # queries of streamed responses run while consumed
+                if response.streaming:
+                    streamed(response)
+            self.assertEqual(response.status_code, 200)
+            for query in queries:
+                self.assertNotIn('_layer"."geom"', query["sql"], url)
+                self.assertNotIn('_entity"."geom"', query["sql"], url)
+
+    def test_extraction_version(self):
+        draw = make_drawing("Versions")
+        self.assertEqual(draw.extraction_version, 1)
+        layers = Layer.objects.filter(drawing=draw).count()
+        draw.rotation = 30
+        draw.save()
+        draw.refresh_from_db()
+        self.assertEqual(draw.extraction_version, 2)
+        self.assertEqual(Layer.objects.filter(drawing=draw).count(), layers)
+        self.assertFalse(Layer.objects.filter(drawing=draw, version=1).exists())
+        self.assertEqual(draw.related_layers.active().count(), layers)
+        draw_id = draw.id
+        preview = draw.preview.name
+        self.assertTrue(draw.preview.storage.exists(preview))
+        # a failed delete keeps layers
+        with patch("django.db.models.Model.delete", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                draw.delete()
+        self.assertEqual(Layer.objects.filter(drawing=draw).count(), layers)
+        with CaptureQueriesContext(connection) as queries:
+            draw.delete()
+        self.assertFalse(draw.preview.storage.exists(preview))
+        # entity rows are not loaded by the ORM collector
+        self.assertFalse(
+            [q for q in queries if '"djeocadengine_entity"."geom"' in q["sql"]]
+        )
+        self.assertFalse(Layer.objects.filter(drawing_id=draw_id).exists())
+        self.assertFalse(Entity.objects.filter(layer__drawing_id=draw_id).exists())
+
+    def test_extraction_transaction(self):
+        draw = make_drawing("Retries")
+        self.assertEqual(draw.extraction_key, extraction_key(draw))
+        layers = set(Layer.objects.filter(drawing=draw).values_list("id", flat=True))
+        # a retried job finds completed work
+        extract_dxf(draw, refresh=True)
+        draw.refresh_from_db()
+        self.assertEqual(draw.extraction_version, 1)
+        # a crash rolls back all rows of the extraction
+        with patch(
+            "djeocadengine.models.purge_layers", side_effect=RuntimeError("crash")
+        ):
+            with self.assertRaises(RuntimeError):
+                extract_dxf(draw, refresh=True, force=True)
+        draw.refresh_from_db()
+        self.assertEqual(draw.extraction_version, 1)
+        self.assertEqual(
+            set(Layer.objects.filter(drawing=draw).values_list("id", flat=True)),
+            layers,
+        )
+        extract_dxf(draw, refresh=True, force=True)
+        draw.refresh_from_db()
+        self.assertEqual(draw.extraction_version, 2)
+        self.assertFalse(Layer.objects.filter(drawing=draw, id__in=layers).exists())
+
+    def test_extraction_coalescing(self):
+        draw = make_drawing("Queued")
+        self.assertIn("lock", draw.extraction_stats["timings"])
+        # another user saves while an extraction request is queued
+        queued = Drawing.objects.get(id=draw.id)
+        draw.rotation = 45
+        draw.save()
+        self.assertEqual(queued.extraction_version, 1)
+        extract_dxf(queued, refresh=True)
+        # queued request runs with latest parameters, finds work done
+        self.assertEqual(queued.rotation, 45)
+        self.assertEqual(queued.extraction_version, 2)
+        # parameters changed but not yet extracted
+        Drawing.objects.filter(id=draw.id).update(rotation=90)
+        extract_dxf(queued, refresh=True)
+        self.assertEqual(queued.rotation, 90)
+        self.assertEqual(queued.extraction_version, 3)
+        self.assertEqual(
+            set(Layer.objects.filter(drawing=draw).values_list("version", flat=True)),
+            {3},
+        )
+
+    def test_stale_drawing_save(self):
+        draw = make_drawing("Stale")
+        layers = draw.related_layers.active().count()
+        preview = draw.preview.name
+        # a form loaded before another user saved
+        stale = Drawing.objects.get(id=draw.id)
+        draw.rotation = 45
+        draw.save()
+        stale.rotation = 90
+        stale.save()
+        draw.refresh_from_db()
+        self.assertEqual(draw.rotation, 90)
+        self.assertEqual(draw.extraction_version, 3)
+        self.assertEqual(draw.related_layers.active().count(), layers)
+        self.assertEqual(Layer.objects.filter(drawing=draw).count(), layers)
+        # extraction state is kept by an edit of other fields
+        stale = Drawing.objects.get(id=draw.id)
+        stale.extraction_version = 1
+        stale.preview = None
+        stale.title = "Edited"
+        stale.save()
+        draw.refresh_from_db()
+        self.assertEqual(draw.title, "Edited")
+        self.assertEqual(draw.extraction_version, 3)
+        self.assertEqual(draw.preview.name, preview)
+
+    def test_hit_test(self):
+        draw = make_drawing("Hits")
+        entity = Entity.objects.filter(drawing=draw, data__has_key="Surface").first()
+        point = entity_shapes(entity.geom)[0].representative_point()
+        drawing_indexes.clear()
+        response = self.client.get(
+            reverse("djeocadengine:hit_test"),
+            {"long": point.x, "lat": point.y, "drawing": draw.id},
+        )
+        self.assertIn(
+            {
+                "id": entity.id,
+                "drawing": draw.id,
+                "layer": entity.layer.name,
+                "layer_id": entity.layer_id,
+                "is_block": False,
+                "data": entity.data,
+            },
+            response.json()["entities"],
+        )
+        index = drawing_indexes.get(draw)
+        self.assertIs(drawing_indexes.get(draw), index)
+        response = self.client.get(
+            reverse("djeocadengine:hit_test"),
+            {"long": point.x, "lat": point.y, "layer": 0},
+        )
+        self.assertEqual(response.json()["entities"], [])
+        # new extraction rebuilds index
+        draw.rotation = 90
+        draw.save()
+        self.assertIsNot(drawing_indexes.get(draw), index)
+        response = self.client.get(reverse("djeocadengine:hit_test"), {"long": "x"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_search(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = make_synthetic_dxf(
+                Path(tmp).joinpath("search.dxf"), layers=2, polylines=12, inserts=4
+            )
+            with open(path, "rb") as f:
+                draw = Drawing(
+                    title="Search",
+                    dxf=SimpleUploadedFile("search.dxf", f.read(), "image/x-dxf"),
+                    geom={"type": "Point", "coordinates": [12.0, 42.0]},
+                )
+                draw.save()
+        response = self.client.get(reverse("djeocadengine:search"), {"q": "room 1"})
+        values = [r["value"] for r in response.json()["results"]]
+        self.assertEqual(values, ["Room 1", "Room 10", "Room 11"])
+        response = self.client.get(
+            reverse("djeocadengine:search"),
+            {"q": "3", "key": "ASSET", "match": "exact"},
+        )
+        results = response.json()["results"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["drawing"], draw.id)
+        self.assertEqual(len(results[0]["location"]), 2)
+        response = self.client.get(reverse("djeocadengine:search"), {"q": " "})
+        self.assertEqual(response.status_code, 404)
+        draw.delete()
+        self.assertFalse(EntityAttribute.objects.exists())
+
+    def test_viewport_geometry(self):
+        draw = make_drawing("Viewport")
+        bbox = ",".join(str(v) for v in draw.bounds)
+        url = reverse("djeocadengine:viewport_geometry")
+        response = self.client.get(url, {"zoom": 10, "bbox": bbox})
+        self.assertEqual(response.json()["features"], [])
+        response = self.client.get(url, {"zoom": 22, "bbox": bbox})
+        collection = json.loads(streamed(response))
+        features = collection["features"]
+        self.assertNotEqual(features, [])
+        self.assertFalse(collection["truncated"])
+        self.assertEqual(
+            Entity.objects.filter(
+                id__in=[f["id"] for f in features], layer__is_block=False
+            ).count(),
+            len(features),
+        )
+        with patch("djeocadengine.views.VIEWPORT_BUDGET", 1):
+            response = self.client.get(url, {"zoom": 22, "bbox": bbox})
+            collection = json.loads(streamed(response))
+        self.assertEqual(len(collection["features"]), 1)
+        self.assertTrue(collection["truncated"])
+        # binary clients get the same members
+        with patch("djeocadengine.views.VIEWPORT_BUDGET", 1):
+            response = self.client.get(
+                url,
+                {"zoom": 22, "bbox": bbox},
+                headers={
+                    "Accept": "application/x-djeocad-geometry",
+                    "Accept-Encoding": "gzip",
+                },
+            )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        content = gzip.decompress(response.content)
+        length = struct.unpack("<I", content[4:8])[0]
+        header = json.loads(content[8 : 8 + length])
+        self.assertEqual(len(header["features"]), 1)
+        self.assertTrue(header["truncated"])
+        response = self.client.get(url, {"zoom": 22})
+        self.assertEqual(response.status_code, 404)
+
+    def test_propagate_georeferencing(self):
+        def positions(draw):
+            return [
+                e.bounds for e in Entity.objects.filter(drawing=draw).order_by("id")
+            ]
+
+        parent = make_drawing(
+            "Parent", geom={"type": "Point", "coordinates": [12.0, 42.0]}
+        )
+        child = make_drawing("Child", parent=parent)
+        # index of child held by another process
+        indexes = IndexCache()
+        index = indexes.get(child)
+        layers = child.related_layers.active().count()
+        parent.geom = {"type": "Point", "coordinates": [12.01, 42.01]}
+        parent.rotation = 45
+        parent.save()
+        version = child.extraction_version
+        child.refresh_from_db()
+        self.assertEqual(child.geom["coordinates"], [12.01, 42.01])
+        self.assertEqual(child.rotation, 45)
+        self.assertTrue(child.needs_refresh)
+        self.assertGreater(child.extraction_version, version)
+        self.assertEqual(child.related_layers.active().count(), layers)
+        self.assertIsNot(indexes.get(child), index)
+        # children are not saved, clusters are reset anyway
+        cache.set(get_cluster_key(10), [])
+        propagate_georeferencing(parent)
+        self.assertIsNone(cache.get(get_cluster_key(10)))
+        # same result as a full extraction
+        reference = make_drawing(
+            "Reference",
+            geom={"type": "Point", "coordinates": [12.01, 42.01]},
+            rotation=45,
+        )
+        # coordinates are stored with 6 decimals, rounding errors add up
+        for a, b in zip(positions(child), positions(reference), strict=True):
+            self.assertEqual(a is None, b is None)
+            for x, y in zip(a or (), b or ()):
+                self.assertAlmostEqual(x, y, delta=5e-6)
+        self.assertAlmostEqual(child.minx, reference.minx, delta=5e-6)
+        # DXF geodata is refreshed on download
+        response = self.client.get(
+            reverse("djeocadengine:drawing_download", kwargs={"pk": child.id})
+        )
+        self.assertEqual(response.status_code, 200)
+        child.refresh_from_db()
+        self.assertFalse(child.needs_refresh)
+
+    def test_curve_flattening(self):
+        msp = ezdxf.new().modelspace()
+        stats = ExtractionStats()
+        for entity in [
+            msp.add_circle((0, 0), 10000),
+            msp.add_circle((0, 0), 0.01),
+            msp.add_spline([(0, 0), (3000, 4000), (6000, -2000), (10000, 5000)]),
+        ]:
+            low, high = FLATTENING_SEGMENTS[entity.dxftype()]
+            segments = count_segments(flatten_curve(entity, (low, high), stats))
+            self.assertGreaterEqual(segments, low)
+            # flattening may add a segment to close the curve
+            self.assertLessEqual(segments, high + 1)
+        flattening = stats.as_dict()["flattening"]
+        self.assertGreater(flattening["saved"]["CIRCLE"], 0)
+        self.assertIn("SPLINE", flattening["segments"])
+
+    def test_validate_polygons(self):
+        msp = ezdxf.new().modelspace()
+        proxies = [
+            geo.proxy(msp.add_lwpolyline([(0, 0), (4, 0), (4, 3), (0, 3)], close=True)),
+            # bow tie, self intersecting
+            geo.proxy(msp.add_lwpolyline([(0, 0), (4, 3), (4, 0), (0, 3)], close=True)),
+        ]
+        stats = ExtractionStats()
+        valid, invalid = validate_polygons(list(proxies), stats)
+        self.assertIs(valid, proxies[0])
+        self.assertFalse(invalid)
+        self.assertEqual(stats.invalid_polygons, 1)
+        self.assertEqual(stats.repaired_polygons, 0)
+        stats = ExtractionStats()
+        with patch("djeocadengine.models.REPAIR_POLYGONS", True):
+            valid, repaired = validate_polygons(list(proxies), stats)
+        self.assertEqual(repaired.geotype, "MultiPolygon")
+        self.assertEqual(stats.repaired_polygons, 1)
+        self.assertEqual(stats.as_dict()["repaired_polygons"], 1)
+        # nearly coincident vertices are checked as stored, once rounded
+        doc = ezdxf.new()
+        doc.modelspace().add_lwpolyline(
+            [(0, 0), (4, 0), (4, 3), (0, 3), (1e-13, 0)], close=True
+        )
+        proxy = geo.proxy(doc.modelspace()[0])
+        stats = ExtractionStats()
+        self.assertIs(validate_polygons([proxy], stats)[0], proxy)
+        self.assertEqual(stats.invalid_polygons, 0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp).joinpath("coincident.dxf")
+            doc.saveas(path)
+            draw = make_drawing(
+                "Coincident",
+                dxf=SimpleUploadedFile(
+                    "coincident.dxf", path.read_bytes(), "image/x-dxf"
+                ),
+            )
+        self.assertEqual(draw.extraction_stats["invalid_polygons"], 0)
+        types = [
+            g["type"]
+            for e in Entity.objects.filter(drawing=draw)
+            for g in e.geom["geometries"]
+        ]
+        self.assertEqual(types, ["Polygon"])
+
+    def test_preview_filter(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = make_synthetic_dxf(
+                Path(tmp).joinpath("preview.dxf"), polylines=30, hatches=10, inserts=10
+            )
+            msp = ezdxf.readfile(path).modelspace()
+        self.assertIsNone(preview_filter(msp))
+        with patch("djeocadengine.models.PREVIEW_MAX_ENTITIES", 20):
+            keep = preview_filter(msp)
+        drawn = [e for e in msp if keep(e)]
+        self.assertEqual(len(drawn), 20)
+        self.assertEqual({e.dxftype() for e in drawn}, {"LWPOLYLINE"})
+
+    def test_insertion_points(self):
+        doc = ezdxf.new()
+        msp = doc.modelspace()
+        block = doc.blocks.new("Tree")
+        block.add_circle((0, 0), 1)
+        inserts = [
+            msp.add_blockref("Tree", (10, 20)),
+            msp.add_blockref("Tree", (-5, 300)),
+        ]
+        entities = len(doc.entitydb)
+        m = Matrix44.translate(300000, 4650000, 0)
+        transformer = get_transformer(32633, 4326)
+        points = insertion_points(inserts, m, transformer)
+        self.assertEqual(len(doc.entitydb), entities)
+        for ins, point in zip(inserts, points):
+            expected = get_geo_proxy(
+                doc.modelspace().add_point(ins.dxf.insert), m, transformer
+            ).__geo_interface__
+            self.assertEqual(point, expected)
+        self.assertEqual(insertion_points([], m, transformer), [])
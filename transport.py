@@ -0,0 +1,232 @@
+import gzip
+import json
+import struct
+import sys
+import zlib
+from array import array
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+# geometry endpoints serve compact GeoJSON or a binary encoding,
+# compressed with brotli (if installed) or gzip when the client accepts it
+GEOJSON_TYPE = "application/json"
+BINARY_TYPE = "application/x-djeocad-geometry"
+BINARY_MAGIC = b"DJG1"
+# coordinates are stored as integers, about 1 cm precision
+BINARY_SCALE = 10**7
+# smaller responses are not worth compressing
+MIN_COMPRESS_SIZE = 200
+# streamed responses are sent in chunks of about this size (bytes)
+STREAM_CHUNK_SIZE = 64 * 1024
+# features of streamed responses are encoded in threads, in batches
+STREAM_BATCH_SIZE = 200
+
+
+def negotiate(request):
+    """Returns (content type, content encoding) accepted by client"""
+    if BINARY_TYPE in request.headers.get("Accept", ""):
+        content_type = BINARY_TYPE
+    else:
+        content_type = GEOJSON_TYPE
+    accepted = [
+        e.split(";")[0].strip()
+        for e in request.headers.get("Accept-Encoding", "").split(",")
+    ]
+    if brotli and "br" in accepted:
+        encoding = "br"
+    elif "gzip" in accepted:
+        encoding = "gzip"
+    else:
+        encoding = None
+    return content_type, encoding
+
+
+def representation_etag(request, etag):
+    """Strong ETag, different for each representation of the resource"""
+    if etag is None:
+        return None
+    content_type, encoding = negotiate(request)
+    suffix = "bin" if content_type == BINARY_TYPE else "json"
+    return f'"{etag}-{suffix}-{encoding or "identity"}"'
+
+
+def template_geometry(geometry, coords):
+    """Moves coordinates to coords list, returns geometry
+    where coordinates are replaced by their counts"""
+    if geometry["type"] == "GeometryCollection":
+        return {
+            "type": "GeometryCollection",
+            "geometries": [
+                template_geometry(g, coords) for g in geometry["geometries"]
+            ],
+        }
+
+    def walk(c):
+        if c and isinstance(c[0], (int, float)):
+            coords.append(c)
+            return 1
+        if c and isinstance(c[0][0], (int, float)):
+            coords.extend(c)
+            return len(c)
+        return [walk(item) for item in c]
+
+    return {"type": geometry["type"], "coordinates": walk(geometry["coordinates"])}
+
+
+def dumps_geojson(collection):
+    return json.dumps(collection, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+
+
+def encode_binary(collection):
+    """Header (magic, length, JSON with geometry templates) followed by
+    delta encoded integer coordinates, decoded by base_list.js"""
+    coords = []
+    features = []
+    for feature in collection["features"]:
+        feature = dict(feature)
+        if feature["geometry"]:
+            feature["geometry"] = template_geometry(feature["geometry"], coords)
+        features.append(feature)
+    # other members of the collection, i.e. truncated
+    members = {k: v for k, v in collection.items() if k not in ("type", "features")}
+    header = json.dumps(
+        {"scale": BINARY_SCALE, **members, "features": features},
+        cls=DjangoJSONEncoder,
+        separators=(",", ":"),
+    ).encode()
+    header += b" " * (-len(header) % 4)
+    values = array("i")
+    x0 = y0 = 0
+    for c in coords:
+        x = round(c[0] * BINARY_SCALE)
+        y = round(c[1] * BINARY_SCALE)
+        values.append(x - x0)
+        values.append(y - y0)
+        x0, y0 = x, y
+    if sys.byteorder == "big":
+        values.byteswap()
+    return BINARY_MAGIC + struct.pack("<I", len(header)) + header + values.tobytes()
+
+
+def compress(content, encoding):
+    if encoding == "br":
+        return brotli.compress(content)
+    return gzip.compress(content, mtime=0)
+
+
+def encode_geometry(collection, content_type, encoding):
+    """Returns (content, encoding) of a FeatureCollection, where
+    encoding is None if content is not compressed"""
+    if content_type == BINARY_TYPE:
+        content = encode_binary(collection)
+    else:
+        content = dumps_geojson(collection)
+    if encoding and len(content) >= MIN_COMPRESS_SIZE:
+        return compress(content, encoding), encoding
+    return content, None
+
+
+def geometry_response(request, collection):
+    """Serializes a FeatureCollection according to request headers"""
+    content_type, encoding = negotiate(request)
+    content, encoding = encode_geometry(collection, content_type, encoding)
+    response = HttpResponse(content, content_type=content_type)
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ["Accept", "Accept-Encoding"])
+    return response
+
+
+def compressor(encoding):
+    """Incremental (compress, flush) functions for encoding"""
+    if encoding == "br":
+        c = brotli.Compressor()
+        return c.process, c.finish
+    # gzip container, with zero mtime as gzip.compress above
+    c = zlib.compressobj(wbits=31)
+    return c.compress, c.flush
+
+
+async def abatched(iterable, size):
+    """Lists of up to size items of an async iterable"""
+    batch = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def dumps_features(features, separator):
+    return separator + b",".join(dumps_geojson(f) for f in features)
+
+
+async def stream_geojson(features, members, encoding):
+    """Compact GeoJSON FeatureCollection, chunked and compressed
+    while features are fetched. Encoding and compression of each
+    batch run in a thread, out of the event loop"""
+    to_thread = partial(sync_to_async, thread_sensitive=False)
+    head = dumps_geojson({"type": "FeatureCollection", **members})
+    chunks = [head[:-1] + b',"features":[']
+    size = 0
+    if encoding:
+        process, finish = compressor(encoding)
+    else:
+        process, finish = (lambda chunk: chunk), (lambda: b"")
+    separator = b""
+    async for batch in abatched(features, STREAM_BATCH_SIZE):
+        chunk = await to_thread(dumps_features)(batch, separator)
+        separator = b","
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield await to_thread(process)(b"".join(chunks))
+            chunks = []
+            size = 0
+    chunks.append(b"]}")
+    yield await to_thread(lambda data: process(data) + finish())(b"".join(chunks))
+
+
+async def ageometry_response(request, features, **members):
+    """Async counterpart of geometry_response, features is an async
+    iterable and members are added to the FeatureCollection. GeoJSON is
+    streamed, binary encoding needs all features and runs, with
+    compression, in a thread"""
+    content_type, encoding = negotiate(request)
+    if content_type == BINARY_TYPE:
+        collection = {**members, "features": [f async for f in features]}
+        content, encoding = await sync_to_async(
+            encode_geometry, thread_sensitive=False
+        )(collection, content_type, encoding)
+        response = HttpResponse(content, content_type=content_type)
+        if encoding:
+            response["Content-Encoding"] = encoding
+    else:
+        response = StreamingHttpResponse(
+            stream_geojson(features, members, encoding), content_type=content_type
+        )
+        if encoding:
+            response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ["Accept", "Accept-Encoding"])
+    return response
+
+
+async def stream_file(file, chunk_size=STREAM_CHUNK_SIZE):
+    """Chunks of a stored file, blocking reads run in a thread"""
+    await sync_to_async(file.open)("rb")
+    try:
+        while chunk := await sync_to_async(file.read)(chunk_size):
+            yield chunk
+    finally:
+        await sync_to_async(file.close)()
@@ -13,12 +13,38 @@ from .views import (
     csv_download,
     drawing_delete_view,
     drawing_download,
+    drawing_markers,
+    hit_test_view,
     layer_delete_view,
+    layer_geometry,
+    metrics_view,
+    search_view,
+    viewport_geometry,
 )
 
 app_name = "djeocadengine"
 urlpatterns = [
     path("", BaseListView.as_view(), name="base_list"),
+    path(
+        "markers/",
+        drawing_markers,
+        name="drawing_markers",
+    ),
+    path(
+        "viewport/",
+        viewport_geometry,
+        name="viewport_geometry",
+    ),
+    path(
+        "hit/",
+        hit_test_view,
+        name="hit_test",
+    ),
+    path(
+        "search/",
+        search_view,
+        name="search",
+    ),
     path(
         _("drawing/add/"),
         DrawingCreateView.as_view(),
@@ -54,6 +80,11 @@ urlpatterns = [
         LayerDetailView.as_view(),
         name="layer_detail",
     ),
+    path(
+        "layer/<pk>/geojson",
+        layer_geometry,
+        name="layer_geometry",
+    ),
     path(
         "layer/<pk>/update",
         LayerUpdateView.as_view(),
@@ -74,4 +105,9 @@ urlpatterns = [
         drawing_download,
         name="drawing_download",
     ),
+    path(
+        "metrics/",
+        metrics_view,
+        name="metrics",
+    ),
 ]
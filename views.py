@@ -1,16 +1,24 @@
 import csv
+import hashlib
 import json
+from math import log, pi, radians, tan
 from typing import Any
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import F, Max, Min
 from django.db.models.query import QuerySet
-from django.http import Http404, HttpResponse
-from django.shortcuts import get_object_or_404
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.cache import cache_control
 from django.views.generic import CreateView, DetailView, ListView, UpdateView
 from filer.models import Image
 
@@ -21,7 +29,25 @@ from .forms import (
     DrawingUpdateForm,
     LayerUpdateForm,
 )
-from .models import Drawing, Entity, Layer
+from .middleware import request_metrics
+from .models import (
+    PUBLISH_GEOMETRY,
+    Drawing,
+    Entity,
+    EntityAttribute,
+    Layer,
+    publish_geometry,
+    refresh_geodata,
+    search_term,
+)
+from .transport import (
+    STREAM_BATCH_SIZE,
+    abatched,
+    ageometry_response,
+    geometry_response,
+    representation_etag,
+    stream_file,
+)
 
 
 class HxTemplateMixin:
@@ -42,19 +68,268 @@ class HxSetupMixin:
         super().setup(request, *args, **kwargs)
 
 
+def parse_bbox(value):
+    """Returns (minx, miny, maxx, maxy) from a comma separated string"""
+    try:
+        bbox = tuple(float(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    if len(bbox) != 4:
+        return None
+    return bbox
+
+
+CLUSTER_GRID = getattr(settings, "CAD_CLUSTER_GRID", 60)
+CLUSTER_TIMEOUT = getattr(settings, "CAD_CLUSTER_TIMEOUT", 3600)
+LIST_PAGINATE_BY = getattr(settings, "CAD_LIST_PAGINATE_BY", 20)
+MAX_ZOOM = 22
+# geometry of all drawings is shown on list map above this zoom
+VIEWPORT_MIN_ZOOM = getattr(settings, "CAD_VIEWPORT_MIN_ZOOM", 18)
+VIEWPORT_BUDGET = getattr(settings, "CAD_VIEWPORT_BUDGET", 2000)
+
+
+def get_cluster_key(zoom):
+    return f"djeocadengine:clusters:{zoom}"
+
+
+def invalidate_clusters():
+    cache.delete_many([get_cluster_key(z) for z in range(MAX_ZOOM + 1)])
+
+
+def cluster_drawings(zoom):
+    """Groups georeferenced drawings in cells of CLUSTER_GRID pixels
+    at given zoom. Returns a list of [long, lat, count, id], where id
+    is None if cell contains more than one drawing"""
+    size = 256 * 2**zoom
+    cells = {}
+    for pk, geom in Drawing.objects.exclude(epsg=None).values_list("id", "geom"):
+        if isinstance(geom, str):
+            geom = json.loads(geom)
+        if not geom:
+            continue
+        long, lat = geom["coordinates"][0], geom["coordinates"][1]
+        # web mercator pixel coordinates
+        x = (long + 180) / 360 * size
+        y = max(min(lat, 85.05), -85.05)
+        y = (1 - log(tan(pi / 4 + radians(y) / 2)) / pi) / 2 * size
+        cell = cells.setdefault(
+            (int(x // CLUSTER_GRID), int(y // CLUSTER_GRID)), [0, 0, 0, pk]
+        )
+        cell[0] += long
+        cell[1] += lat
+        cell[2] += 1
+    clusters = []
+    for long, lat, count, pk in cells.values():
+        clusters.append([long / count, lat / count, count, pk if count == 1 else None])
+    return clusters
+
+
+def drawing_markers(request):
+    """Clustered markers of georeferenced drawings within bbox"""
+    try:
+        zoom = int(request.GET.get("zoom", settings.LEAFLET_CONFIG["DEFAULT_ZOOM"]))
+    except ValueError:
+        raise Http404("Invalid zoom")
+    zoom = max(0, min(zoom, MAX_ZOOM))
+    bbox = parse_bbox(request.GET.get("bbox"))
+    clusters = cache.get(get_cluster_key(zoom))
+    if clusters is None:
+        clusters = cluster_drawings(zoom)
+        cache.set(get_cluster_key(zoom), clusters, CLUSTER_TIMEOUT)
+    if bbox:
+        clusters = [
+            c
+            for c in clusters
+            if bbox[0] <= c[0] <= bbox[2] and bbox[1] <= c[1] <= bbox[3]
+        ]
+    drawings = Drawing.objects.in_bulk([c[3] for c in clusters if c[3]])
+    features = []
+    for long, lat, count, pk in clusters:
+        if pk and pk not in drawings:
+            continue
+        properties = {"count": count}
+        if pk:
+            properties["id"] = pk
+            properties["popupContent"] = drawings[pk].popupContent
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [long, lat]},
+                "properties": properties,
+            }
+        )
+    return JsonResponse({"type": "FeatureCollection", "features": features})
+
+
+def hit_test_view(request):
+    """Entities with data at long / lat, eventually filtered
+    by drawing and layers"""
+    try:
+        long = float(request.GET["long"])
+        lat = float(request.GET["lat"])
+        layers = {int(pk) for pk in request.GET.getlist("layer")}
+        drawing = int(request.GET.get("drawing", 0))
+    except (KeyError, ValueError):
+        raise Http404("Invalid coordinates")
+    # shapely is loaded only when needed
+    from .spatial import HIT_TEST_TOLERANCE, hit_test
+
+    t = HIT_TEST_TOLERANCE
+    drawings = Drawing.objects.overlapping(long - t, lat - t, long + t, lat + t)
+    if drawing:
+        drawings = drawings.filter(id=drawing)
+    entities = hit_test(drawings, long, lat, layers=layers)
+    return JsonResponse(
+        {
+            "entities": [
+                {
+                    "id": e.id,
+                    "drawing": e.drawing_id,
+                    "layer": e.layer.name,
+                    "layer_id": e.layer_id,
+                    "is_block": e.layer.is_block,
+                    "data": e.data,
+                }
+                for e in entities
+            ]
+        }
+    )
+
+
+def search_view(request):
+    """Entities whose names or attributes match q, by prefix
+    or exactly if match=exact, eventually filtered by key"""
+    term = search_term(request.GET.get("q", ""))
+    if not term:
+        raise Http404("Empty search")
+    try:
+        limit = max(1, min(int(request.GET.get("limit", 50)), 200))
+    except ValueError:
+        raise Http404("Invalid limit")
+    if request.GET.get("match") == "exact":
+        attributes = EntityAttribute.objects.filter(term=term)
+    else:
+        # range lookup uses the index on all database backends
+        attributes = EntityAttribute.objects.filter(
+            term__gte=term, term__lt=term + "\U0010ffff"
+        )
+    if request.GET.get("key"):
+        attributes = attributes.filter(key=request.GET["key"])
+    attributes = (
+        attributes.filter(entity__layer__version=F("drawing__extraction_version"))
+        .select_related("drawing", "entity__layer")
+        .defer("entity__geom", "entity__layer__geom")
+        .order_by("term", "id")[:limit]
+    )
+    results = []
+    for a in attributes:
+        if a.entity.insertion:
+            location = a.entity.insertion["coordinates"]
+        elif a.entity.bounds:
+            b = a.entity.bounds
+            location = [(b[0] + b[2]) / 2, (b[1] + b[3]) / 2]
+        else:
+            location = None
+        results.append(
+            {
+                "drawing": a.drawing_id,
+                "title": a.drawing.title,
+                "url": a.drawing.get_absolute_url(),
+                "entity": a.entity_id,
+                "layer": a.entity.layer.name,
+                "key": a.key,
+                "value": a.value,
+                "location": location,
+            }
+        )
+    return JsonResponse({"results": results})
+
+
+async def viewport_geometry(request):
+    """Simplified geometry of all drawings within bbox, largest entities
+    first, up to a budget of features"""
+    try:
+        zoom = int(request.GET.get("zoom", 0))
+    except ValueError:
+        raise Http404("Invalid zoom")
+    bbox = parse_bbox(request.GET.get("bbox"))
+    if not bbox:
+        raise Http404("Invalid bbox")
+    if zoom < VIEWPORT_MIN_ZOOM:
+        return geometry_response(
+            request, {"type": "FeatureCollection", "features": [], "truncated": False}
+        )
+    from .spatial import simplify_geometry
+
+    # about a pixel, in degrees
+    tolerance = 360 / (256 * 2 ** min(zoom, MAX_ZOOM))
+    entities = (
+        Entity.objects.overlapping(*bbox)
+        .filter(
+            layer__is_block=False,
+            layer__version=F("drawing__extraction_version"),
+        )
+        .exclude(maxx__lt=F("minx") + tolerance, maxy__lt=F("miny") + tolerance)
+        .select_related("layer")
+        .defer("layer__geom")
+        .order_by(((F("maxx") - F("minx")) * (F("maxy") - F("miny"))).desc(), "id")
+    )
+    truncated = await entities[VIEWPORT_BUDGET:].aexists()
+
+    def simplified(batch):
+        features = []
+        for entity in batch:
+            geometry = simplify_geometry(entity.geom, tolerance)
+            if not geometry["geometries"]:
+                continue
+            feature = entity.get_feature()
+            feature["geometry"] = geometry
+            features.append(feature)
+        return features
+
+    async def features():
+        # shapely runs in a thread, out of the event loop
+        simplify = sync_to_async(simplified, thread_sensitive=False)
+        async for batch in abatched(entities[:VIEWPORT_BUDGET], STREAM_BATCH_SIZE):
+            for feature in await simplify(batch):
+                yield feature
+
+    return await ageometry_response(request, features(), truncated=truncated)
+
+
 class BaseListView(HxTemplateMixin, ListView):
     model = Drawing
     context_object_name = "drawings"
     template_name = "djeocadengine/base_list.html"
+    paginate_by = LIST_PAGINATE_BY
 
     def get_queryset(self) -> QuerySet[Any]:
-        qs = Drawing.objects.exclude(epsg=None)
+        qs = Drawing.objects.exclude(epsg=None).order_by("title", "id")
+        bbox = parse_bbox(self.request.GET.get("bbox"))
+        if bbox:
+            qs = qs.overlapping(*bbox)
         return qs
 
     def get_context_data(self, **kwargs) -> dict[str, Any]:
         context = super().get_context_data(**kwargs)
-        context["unreferenced"] = Drawing.objects.filter(epsg=None)
+        unreferenced = Drawing.objects.filter(epsg=None).order_by("title", "id")
+        context["unreferenced"] = Paginator(unreferenced, LIST_PAGINATE_BY).get_page(
+            self.request.GET.get("unreferenced_page")
+        )
         context["leaflet_config"] = settings.LEAFLET_CONFIG
+        context["marker_url"] = reverse("djeocadengine:drawing_markers")
+        context["viewport"] = {
+            "url": reverse("djeocadengine:viewport_geometry"),
+            "min_zoom": VIEWPORT_MIN_ZOOM,
+        }
+        extents = self.object_list.aggregate(
+            Min("minx"), Min("miny"), Max("maxx"), Max("maxy")
+        )
+        if extents["minx__min"] is not None:
+            context["bounds"] = [
+                [extents["miny__min"], extents["minx__min"]],
+                [extents["maxy__max"], extents["maxx__max"]],
+            ]
         return context
 
     def dispatch(self, request, *args, **kwargs):
@@ -80,6 +355,7 @@ class DrawingCreateView(PermissionRequiredMixin, HxSetupMixin, CreateView):
             )
             form.instance.image = img
             form.instance.temp_image = None
+            form.instance.make_thumbnail()
         return super().form_valid(form)
 
     def get_success_url(self):
@@ -152,15 +428,22 @@ class DrawingDetailView(HxTemplateMixin, DetailView):
 
     def get_context_data(self, **kwargs) -> dict[str, Any]:
         context = super().get_context_data(**kwargs)
-        layers = self.object.related_layers.filter(is_block=False)
-        id_list = layers.values_list("id", flat=True)
-        context["lines"] = Entity.objects.filter(
-            layer_id__in=id_list
-        ).prefetch_related()
+        layers = self.object.related_layers.active().filter(is_block=False)
         context["drawings"] = self.object
-        name_list = layers.values_list("name", flat=True)
-        context["layer_list"] = list(dict.fromkeys(name_list))
-        context["layer_list"] = [_("Layer - ") + s for s in context["layer_list"]]
+        # layer geometries are loaded client side when visible,
+        # from static exports if published
+        context["layer_list"] = [
+            {
+                "id": layer.id,
+                "name": _("Layer - ") + layer.name,
+                "color": layer.color_field,
+                "linetype": layer.linetype,
+                "url": layer.get_geometry_url(),
+            }
+            for layer in layers.defer("geom")
+        ]
+        context["bounds"] = self.object.leaflet_bounds
+        context["overlapping"] = self.object.get_overlapping()
         return context
 
     def dispatch(self, request, *args, **kwargs):
@@ -187,8 +470,10 @@ class DrawingUpdateView(PermissionRequiredMixin, HxSetupMixin, UpdateView):
     def get_context_data(self, **kwargs) -> dict[str, Any]:
         context = super().get_context_data(**kwargs)
         context["drawings"] = self.object
-        context["layers"] = self.object.related_layers.filter(is_block=False)
-        context["blocks"] = self.object.related_layers.filter(is_block=True)
+        # geometry is not needed to list layers and blocks
+        layers = self.object.related_layers.active().defer("geom")
+        context["layers"] = layers.filter(is_block=False)
+        context["blocks"] = layers.filter(is_block=True)
         context["map_status"] = {"map_on_click": True}
         return context
 
@@ -201,6 +486,7 @@ class DrawingUpdateView(PermissionRequiredMixin, HxSetupMixin, UpdateView):
             )
             form.instance.image = img
             form.instance.temp_image = None
+            form.instance.make_thumbnail()
         form.instance.geom = {
             "type": "Point",
             "coordinates": [form.cleaned_data["long"], form.cleaned_data["lat"]],
@@ -235,16 +521,60 @@ def drawing_delete_view(request, pk):
 
 class LayerDetailView(HxSetupMixin, DetailView):
     model = Layer
+    queryset = Layer.objects.defer("geom")
     template_name = "djeocadengine/htmx/layer_inline.html"
     context_object_name = "layer"
 
 
+def layer_etag(request, pk):
+    """Changes with layer style, drawing geolocation and representation"""
+    layer = (
+        Layer.objects.filter(id=pk)
+        .values_list(
+            "id",
+            "color_field",
+            "linetype",
+            "drawing__geom",
+            "drawing__designx",
+            "drawing__designy",
+            "drawing__rotation",
+        )
+        .first()
+    )
+    if not layer:
+        return None
+    return representation_etag(request, hashlib.md5(str(layer).encode()).hexdigest())
+
+
+@cache_control(no_cache=True)
+async def layer_geometry(request, pk):
+    # condition() would call layer_etag outside of a thread
+    etag = await sync_to_async(layer_etag)(request, pk)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        layer = await aget_object_or_404(
+            Layer.objects.defer("geom"), id=pk, is_block=False
+        )
+        response = await ageometry_response(request, layer.aiter_features())
+    if etag:
+        response.headers.setdefault("ETag", etag)
+    return response
+
+
 class LayerUpdateView(PermissionRequiredMixin, HxSetupMixin, UpdateView):
     permission_required = "djeocadengine.change_layer"
     model = Layer
+    queryset = Layer.objects.defer("geom")
     form_class = LayerUpdateForm
     template_name = "djeocadengine/htmx/layer_update.html"
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # exported geometry carries layer style
+        if PUBLISH_GEOMETRY:
+            publish_geometry(self.object.drawing)
+        return response
+
     def get_success_url(self):
         return reverse(
             "djeocadengine:layer_detail",
@@ -254,7 +584,7 @@ class LayerUpdateView(PermissionRequiredMixin, HxSetupMixin, UpdateView):
 
 @permission_required("djeocadengine.delete_layer")
 def layer_delete_view(request, pk):
-    layer = get_object_or_404(Layer, id=pk)
+    layer = get_object_or_404(Layer.objects.defer("geom"), id=pk)
     if not request.htmx or layer.name == "0":
         raise Http404("Request without HTMX headers")
     layer.delete()
@@ -265,20 +595,43 @@ def layer_delete_view(request, pk):
     )
 
 
-def csv_download(request, pk):
-    drawing = get_object_or_404(Drawing, id=pk)
-    # Create the HttpResponse object with the appropriate CSV header.
-    response = HttpResponse(content_type="text/csv")
+class Echo:
+    """Pseudo buffer, csv writer returns rows instead of writing them"""
+
+    def write(self, value):
+        return value
+
+
+async def csv_download(request, pk):
+    drawing = await aget_object_or_404(Drawing, id=pk)
+    writer = csv.writer(Echo())
+
+    async def rows():
+        yield writer.writerow(drawing.csv_header())
+        async for e in drawing.csv_entities():
+            yield writer.writerow(drawing.csv_row(e))
+
+    # rows are streamed while fetched, without holding a worker thread
+    response = StreamingHttpResponse(rows(), content_type="text/csv")
     response["Content-Disposition"] = f'attachment; filename="{drawing.title}.csv"'
-    writer = csv.writer(response)
-    writer = drawing.write_csv(writer)
 
     return response
 
 
-def drawing_download(request, pk):
-    drawing = get_object_or_404(Drawing, id=pk)
-    response = HttpResponse(drawing.dxf, content_type="text/plain")
+async def drawing_download(request, pk):
+    drawing = await aget_object_or_404(Drawing, id=pk)
+    # georeferencing inherited from parent is written lazily
+    if drawing.needs_refresh:
+        await sync_to_async(refresh_geodata)(drawing)
+    response = StreamingHttpResponse(
+        stream_file(drawing.dxf), content_type="text/plain"
+    )
     response["Content-Disposition"] = "attachment; filename=%s.dxf" % drawing.title
 
     return response
+
+
+def metrics_view(request):
+    if not request.user.is_staff:
+        raise Http404("Metrics are restricted to staff")
+    return JsonResponse(request_metrics.aggregates())